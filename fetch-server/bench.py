@@ -0,0 +1,398 @@
+"""
+Offline benchmarks: fetch runs against the in-memory Gmail fake, parse over a
+synthetic corpus covering every bank format, txfile over a generated
+transactions.json, and /ping latency of the web server under load.
+
+    python bench.py fetch [--messages 200] [--latency 0.05] [--batch-size 50]
+    python bench.py parse [--emails 2000]
+    python bench.py txfile [--transactions 100000]
+    python bench.py serve [--emails 5000] [--readers 4]
+"""
+import argparse
+import contextlib
+import email as email_lib
+import http.client
+import io
+import json
+import os
+import random
+import re
+import socket
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import config as cfg
+import db
+import pipeline
+import txfile
+from fakes import FakeDropbox, FakeGmailService
+
+LABEL = 'Label_bench'
+
+
+def _alert(n: int) -> bytes:
+    body = (
+        f"> Apr {n % 28 + 1:02d}, 2026 \r\n"
+        f">Merchant<x<td class='c'>STORE {n}</td>\r\n"
+        f">Amount<x<td class='c'>${n % 500}.{n % 100:02d}</td>\r\n"
+    ) * 20
+    return f"From: noreply@chase.com\r\nSubject: Alert {n}\r\n\r\n{body}".encode()
+
+
+def bench_fetch(args) -> None:
+    """Catch-up download of --messages unseen alerts, serial vs batched."""
+    print(f'{args.messages} messages, {args.latency * 1000:.0f}ms per round-trip')
+    for label, batch_size in [('serial', 1), (f'batch={args.batch_size}', args.batch_size)]:
+        service = FakeGmailService(latency=args.latency)
+        gmail_ids = [service.add_message(_alert(n), [LABEL]) for n in range(args.messages)]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench.db')
+            db.init_db(path)
+            conn = db.get_conn(path)
+            run_id = db.start_run(conn)
+            start = time.perf_counter()
+            pipeline._download_messages(conn, service, gmail_ids, run_id, lambda _: None, batch_size)
+            elapsed = time.perf_counter() - start
+            conn.close()
+        print(f'  {label:<10} {elapsed:7.2f}s  {service.calls["batch"]} round-trip(s)')
+
+
+def _qp_lines(html: str) -> str:
+    """Wrap quoted-printable text at 76 columns with soft line breaks."""
+    lines, start = [], 0
+    while start < len(html):
+        end = start + 75
+        while '=' in html[end - 2:end]:  # don't split an =XX escape
+            end -= 1
+        lines.append(html[start:end])
+        start = end
+    return '=\r\n'.join(lines)
+
+
+def _corpus_email(n: int) -> bytes:
+    """One synthetic alert, cycling through every supported bank format."""
+    filler = ''.join(f'<td style=3D"color:#{i:06x}" class=3D"c{i}">row=C2=A0{i}</td>'
+                     for i in range(300))
+    kind = n % 5
+    if kind == 0:
+        body = _qp_lines(
+            f"<table><tr><td>> Apr {n % 28 + 1:02d}, 2026 </td></tr>{filler}"
+            f"<tr><td>>Merchant<x<td class=3D'c'>STORE {n}</td>"
+            f"<td>>Amount<x<td class=3D'c'>${n % 900}.{n % 100:02d}</td></tr></table>")
+        return f"From: no.reply.alerts@chase.com\r\nSubject: Alert {n}\r\n\r\n{body}".encode()
+    if kind == 1:
+        body = _qp_lines(
+            f"<table><tr><td>> Feb {n % 28 + 1:02d}, 2026 </td></tr>{filler}"
+            f"<tr><td>>Merchant: <x<td class=3D'c'> HOTEL {n}</td>"
+            f"<td>>Authorized  amount: <x<td class=3D'c'> ${n % 900}.00  </td></tr></table>")
+        return f"From: alerts@jpmorgan.com\r\nSubject: Alert {n}\r\n\r\n{body}".encode()
+    subject, text = [
+        ('USAA: Your Bank Account Received a Deposit',
+         'From: My Employer\nYou received a deposit for $1,234.00 to your account\n'),
+        ('Deposit to Your Bank Account',
+         'From: Social Security\nYou received a deposit of $2,000.00 to your account\n'),
+        ('Debit Alert for Your USAA Bank Account',
+         'To: Electric Company\n$150.00 came out of your account\n'),
+    ][kind - 2]
+    msg = MIMEMultipart()
+    msg['From'] = 'notify@usaa.com'
+    msg['Subject'] = subject
+    msg.attach(MIMEText(f'Date: 04/{n % 28 + 1:02d}/26\n{text}' + 'filler line\n' * 200,
+                        'plain', 'us-ascii'))
+    return msg.as_bytes()
+
+
+# The parser as it was before parsers.py, kept as the "before" of bench parse:
+# an if/elif over the headers, a full MIME parse, four str.replace passes over
+# the body and patterns recompiled (via re's cache) on every search.
+
+_LEGACY_CHASE = {
+    'source': 'email_chase',
+    'description': r'>Merchant<[^<]+<td [^>]+>(?P<description>[^<]+)</td>',
+    'amount': r'>Amount<[^<]+<td [^>]+>[$](?P<amount>[0-9.,]+)</td>',
+    'credit amount': r'>Credit Amount<[^<]+<td [^>]+>[$](?P<amount>[0-9.,]+)</td>',
+}
+_LEGACY_JPMORGAN = {
+    'source': 'email_chase',
+    'description': r'>Merchant: <[^<]+<td [^>]+> (?P<description>[^<]+)</td>',
+    'amount': (r'>Authorized  (incremental )?amount:'
+               r'(<sup[^<]+<str[^<]+</strong></sup>)?'
+               r' <[^<]+<td [^>]+> [$](?P<amount>[0-9.,]+)  </td>'),
+}
+_LEGACY_USAA_DEPOSIT = {
+    'source': 'email_usaa',
+    'description': r'From: (?P<description>[A-Za-z ]+)',
+    'amount': r'NOTHING_NOT_IN_EMAIL',
+    'credit amount': r'You received a deposit for [$](?P<amount>[0-9.,]+) to your',
+}
+_LEGACY_USAA2_DEPOSIT = {
+    'source': 'email_usaa',
+    'description': r'From: (?P<description>[A-Za-z ]+)',
+    'amount': r'NOTHING_NOT_IN_EMAIL',
+    'credit amount': r'You received a deposit of [$](?P<amount>[0-9.,]+) to your',
+}
+_LEGACY_USAA_DEBIT = {
+    'source': 'email_usaa',
+    'description': r'To: (?P<description>[A-Za-z ]+)',
+    'amount': r'[$](?P<amount>[0-9.,]+) came out of your account',
+}
+_LEGACY_MONTHS = {
+    'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04', 'May': '05', 'Jun': '06',
+    'Jul': '07', 'Aug': '08', 'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12',
+}
+
+
+def _legacy_email_to_transaction(gmail_id: str, msg, patterns: dict) -> dict:
+    body = (msg.get_payload()
+            .replace('=\r\n', '')
+            .replace('=3D', '=')
+            .replace('=C2=A0', ' ')
+            .replace('=0D=09', ' '))
+    m = re.search(r'> ?(?P<mmm>\w+) (?P<dd>\d+), (?P<yyyy>\d+) ', body, re.MULTILINE | re.DOTALL)
+    if m:
+        date = f"{m.group('yyyy')}-{_LEGACY_MONTHS[m.group('mmm')]}-{m.group('dd').zfill(2)}"
+    else:
+        m = re.search(r'Date: (?P<mm>\d\d)/(?P<dd>\d\d)/(?P<yy>\d\d)', body,
+                      re.MULTILINE | re.DOTALL)
+        date = f"20{m.group('yy')}-{m.group('mm')}-{m.group('dd')}"
+    m = re.search(patterns['description'], body, re.MULTILINE | re.DOTALL)
+    description = m.group('description')
+    m = re.search(patterns['amount'], body, re.MULTILINE | re.DOTALL)
+    multiplier = 1
+    if not m:
+        m = re.search(patterns['credit amount'], body, re.MULTILINE | re.DOTALL)
+        multiplier = -1
+    amount = int(float(m.group('amount').replace(',', '')) * 100.0 * multiplier)
+    return {'id': gmail_id, 'description': description,
+            'original_line': msg.get('Subject') or gmail_id, 'date': date, 'tags': [],
+            'amount_cents': amount, 'transactions': [], 'source': patterns['source'],
+            'notes': ''}
+
+
+def _legacy_parse_email(gmail_id: str, raw: bytes) -> dict:
+    msg = email_lib.message_from_string(raw.decode('utf-8', errors='replace'))
+    from_addr = msg.get('From', '')
+    subject = msg.get('Subject', '')
+    if '@chase.com' in from_addr:
+        return _legacy_email_to_transaction(gmail_id, msg, _LEGACY_CHASE)
+    elif '@jpmorgan.com' in from_addr:
+        return _legacy_email_to_transaction(gmail_id, msg, _LEGACY_JPMORGAN)
+    elif 'USAA: Your Bank Account Received a Deposit' in subject:
+        return _legacy_email_to_transaction(gmail_id, msg.get_payload()[0], _LEGACY_USAA_DEPOSIT)
+    elif 'Deposit to Your Bank Account' in subject:
+        return _legacy_email_to_transaction(gmail_id, msg.get_payload()[0], _LEGACY_USAA2_DEPOSIT)
+    elif 'Debit Alert for Your USAA Bank Account' in subject:
+        return _legacy_email_to_transaction(gmail_id, msg.get_payload()[0], _LEGACY_USAA_DEBIT)
+    raise ValueError(f'Unknown email format: from={from_addr!r} subject={subject!r}')
+
+
+def _best_per_email(parse, corpus: list) -> float:
+    best = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        for gmail_id, raw in corpus:
+            parse(gmail_id, raw)
+        best = min(best, time.perf_counter() - start)
+    return best / len(corpus)
+
+
+def bench_parse(args) -> None:
+    """Per-email cost of _parse_email over a synthetic mixed-bank corpus,
+    against the pre-parsers.py implementation above."""
+    corpus = [(f'id{n}', _corpus_email(n)) for n in range(args.emails)]
+    for gmail_id, raw in corpus[:5]:
+        # Fail fast if the corpus doesn't parse, or the two disagree.
+        assert _legacy_parse_email(gmail_id, raw) == pipeline._parse_email(gmail_id, raw)
+    size = sum(len(raw) for _, raw in corpus) / len(corpus)
+    print(f'{args.emails} emails, {size / 1024:.1f}KB average, best of 3')
+    for label, parse in [('before', _legacy_parse_email), ('after', pipeline._parse_email)]:
+        print(f'  {label:<7} {_best_per_email(parse, corpus) * 1e6:7.1f}us per email')
+
+
+def _transactions_file(count: int) -> list:
+    """A multi-year history; every tenth transaction is split in two."""
+    rng = random.Random(0)
+    transactions = []
+    for n in range(count):
+        t = {
+            'id': f'{n:016x}',
+            'description': rng.choice(['TRADER JOE\'S', 'SHELL OIL 5744', 'CAFÉ LUNA', 'AMAZON.COM']),
+            'original_line': f'Your transaction alert {n}',
+            'date': f'20{rng.randint(16, 26)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+            'tags': rng.choice([[], ['food'], ['car', 'gas']]),
+            'amount_cents': rng.randint(-50000, 50000),
+            'transactions': [],
+            'source': 'email_chase',
+            'notes': '',
+        }
+        if n % 10 == 0:
+            t['transactions'] = [dict(t, id=f'{n:016x}-{i}', transactions=[]) for i in range(2)]
+        transactions.append(t)
+    transactions.sort(key=lambda t: t['date'], reverse=True)
+    return transactions
+
+
+def _peak(fn, *args) -> int:
+    """Peak bytes allocated while fn ran, including its result."""
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def _best(fn, *args) -> float:
+    best = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_txfile(args) -> None:
+    """Load and dump of transactions.json: json str round-trip vs txfile."""
+    data = json.dumps(_transactions_file(args.transactions)).encode('utf-8')
+    transactions = json.loads(data)
+    print(f'{args.transactions} transactions, {len(data) / 2**20:.1f}MB'
+          f' (orjson {"installed" if txfile.orjson else "not installed"})')
+    for label, load, dump in [
+        ('json', lambda d: json.loads(d.decode('utf-8')), lambda t: json.dumps(t).encode('utf-8')),
+        ('txfile', txfile.load, txfile.dump),
+    ]:
+        assert load(data) == transactions and dump(transactions) == data
+        print(f'  {label:<7} load {_best(load, data) * 1000:5.0f}ms'
+              f' peak {_peak(load, data) / 2**20:5.1f}MB'
+              f'   dump {_best(dump, transactions) * 1000:5.0f}ms'
+              f' peak {_peak(dump, transactions) / 2**20:5.1f}MB')
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _ping_latencies(port: int, stop: threading.Event) -> list:
+    """GET /ping back to back on one connection until stop is set; seconds each."""
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    latencies = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        conn.request('GET', '/ping')
+        conn.getresponse().read()
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.005)
+    conn.close()
+    return latencies
+
+
+def _hammer(port: int, path: str, stop: threading.Event, counts: list) -> None:
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    while not stop.is_set():
+        conn.request('GET', path)
+        conn.getresponse().read()
+        counts.append(1)
+    conn.close()
+
+
+def _summary(latencies: list) -> str:
+    q = statistics.quantiles(latencies, n=100, method='inclusive')
+    return (f'p50 {q[49] * 1000:6.1f}ms  p95 {q[94] * 1000:6.1f}ms  '
+            f'max {max(latencies) * 1000:7.1f}ms  ({len(latencies)} pings)')
+
+
+def bench_serve(args) -> None:
+    """/ping latency idle vs. while run pages load and a pipeline run parses."""
+    tmp_dir = tempfile.TemporaryDirectory()
+    tmp = tmp_dir.name
+    config = {**cfg.DEFAULTS, 'db_path': os.path.join(tmp, 'bench.db'), 'gmail_label_id': LABEL,
+              'dropbox_path': '/p', 'dropbox_cache_file': os.path.join(tmp, 'cache.json')}
+    db.init_db(config['db_path'])
+    conn = db.get_conn(config['db_path'])
+    run_id = db.start_run(conn)
+    db.save_emails_many(conn, [(f'id{n}', _alert(n), f'Alert {n}', 'noreply@chase.com')
+                               for n in range(args.emails)], run_id)
+    db.finish_run(conn, run_id, 'success', emails_downloaded=args.emails)
+    conn.close()
+
+    service, dropbox = FakeGmailService(latency=0.05), FakeDropbox()
+    for n in range(100):
+        service.add_message(_alert(args.emails + n), [LABEL])
+    dropbox.put('/p', b'[]')
+    pipeline.gmail_service = lambda token_file, credentials_file: service
+    pipeline.dropbox_module.Dropbox = lambda token: dropbox
+    cfg.load = lambda: config
+    import server
+    import uvicorn
+
+    port = _free_port()
+    uv = uvicorn.Server(uvicorn.Config(server.app, host='127.0.0.1', port=port,
+                                       log_level='warning', lifespan='off'))
+    threading.Thread(target=uv.run, daemon=True).start()
+    while not uv.started:
+        time.sleep(0.01)
+
+    print(f'run page with {args.emails} emails, {args.readers} reader(s), '
+          f'pipeline run parsing {args.emails + 100} emails')
+    stop = threading.Event()
+    timer = threading.Timer(2, stop.set)
+    timer.start()
+    print(f'  idle    {_summary(_ping_latencies(port, stop))}')
+
+    stop = threading.Event()
+    loads = []
+    readers = [threading.Thread(target=_hammer, args=(port, f'/run/{run_id}', stop, loads))
+               for _ in range(args.readers)]
+    fetch = threading.Thread(target=server._do_run)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for t in readers:
+            t.start()
+        fetch.start()
+        start = time.perf_counter()
+        threading.Thread(target=lambda: (fetch.join(), stop.set())).start()
+        latencies = _ping_latencies(port, stop)
+        elapsed = time.perf_counter() - start
+        for t in readers:
+            t.join()
+    print(f'  loaded  {_summary(latencies)}')
+    print(f'  {len(loads)} run page load(s) and a {elapsed:.1f}s pipeline run meanwhile')
+    uv.should_exit = True
+    tmp_dir.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    fetch = sub.add_parser('fetch', help=bench_fetch.__doc__)
+    fetch.add_argument('--messages', type=int, default=200)
+    fetch.add_argument('--latency', type=float, default=0.05)
+    fetch.add_argument('--batch-size', type=int, default=50)
+    fetch.set_defaults(func=bench_fetch)
+
+    parse = sub.add_parser('parse', help=bench_parse.__doc__)
+    parse.add_argument('--emails', type=int, default=2000)
+    parse.set_defaults(func=bench_parse)
+
+    tx = sub.add_parser('txfile', help=bench_txfile.__doc__)
+    tx.add_argument('--transactions', type=int, default=100_000)
+    tx.set_defaults(func=bench_txfile)
+
+    serve = sub.add_parser('serve', help=bench_serve.__doc__)
+    serve.add_argument('--emails', type=int, default=5000)
+    serve.add_argument('--readers', type=int, default=4)
+    serve.set_defaults(func=bench_serve)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,11 +7,19 @@ CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'config.json')
 DEFAULTS = {
     'dropbox_access_token': '',
     'dropbox_path': '/spent tracker/transactions.json',
+    'dropbox_cache_file': 'transactions_cache.json',
+    'dropbox_delta_mode': False,
+    'dropbox_compact_bytes': 256 * 1024,
+    'dropbox_compact_hour': 3,
     'gmail_label_id': 'Label_6978996750297338417',
     'gmail_token_file': 'token.json',
     'gmail_credentials_file': 'credentials.json',
     'db_path': 'fetch_server.db',
+    'gmail_batch_size': 50,
+    'parse_workers': 1,
+    'replay_days': 7,
     'fetch_interval_minutes': 60,
+    'runs_page_size': 50,
     'summary_to': '',
     'summary_hour': 6,
 }
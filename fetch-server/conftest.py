@@ -0,0 +1,19 @@
+"""Fixtures shared by the test modules."""
+import pytest
+
+import db
+
+
+@pytest.fixture
+def db_path(tmp_path) -> str:
+    """Path of a new, fully migrated database."""
+    path = str(tmp_path / 'test.db')
+    db.init_db(path)
+    return path
+
+
+@pytest.fixture
+def conn(db_path):
+    c = db.get_conn(db_path)
+    yield c
+    c.close()
@@ -1,4 +1,7 @@
+import base64
 import sqlite3
+import zlib
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 
@@ -9,16 +12,16 @@ CREATE TABLE IF NOT EXISTS fetch_runs (
     started_at  TEXT NOT NULL,
     finished_at TEXT,
     status      TEXT NOT NULL DEFAULT 'running',  -- running | success | error
-    log         TEXT NOT NULL DEFAULT '',
+    log         TEXT NOT NULL DEFAULT '',  -- superseded by run_log; always empty
     emails_downloaded   INTEGER NOT NULL DEFAULT 0,
     emails_parsed       INTEGER NOT NULL DEFAULT 0,
     transactions_added  INTEGER NOT NULL DEFAULT 0,
-    added_transactions  TEXT     -- JSON array of transaction dicts
+    added_transactions  TEXT     -- superseded by transactions.added_at; always NULL
 );
 
 CREATE TABLE IF NOT EXISTS emails (
     gmail_id     TEXT PRIMARY KEY,
-    raw_content  TEXT NOT NULL,
+    raw_content  TEXT NOT NULL,  -- replaced by compressed raw BLOB (migration 4)
     subject      TEXT,
     from_addr    TEXT,
     downloaded_at TEXT NOT NULL,
@@ -27,14 +30,36 @@ CREATE TABLE IF NOT EXISTS emails (
     parsed_at     TEXT,
     parse_error   TEXT
 );
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    key         TEXT PRIMARY KEY,  -- e.g. gmail_history_id
+    value       TEXT NOT NULL,
+    updated_at  TEXT NOT NULL
+);
 """
 # gmail_id doubles as the transaction id in transactions.json for email-sourced
 # transactions, so no separate transaction_id column is needed.
 
 
+class Connection(sqlite3.Connection):
+    """sqlite3 connection whose helper commits can be deferred by transaction()."""
+    _transaction_depth = 0
+
+
+# Per-connection tuning. WAL lets dashboard reads proceed while a pipeline run
+# is writing; NORMAL sync is durable enough under WAL and skips an fsync per
+# commit; busy_timeout makes a second writer wait rather than fail.
+BUSY_TIMEOUT_MS = 30000
+MMAP_SIZE = 64 * 1024 * 1024
+
+
 def get_conn(db_path: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn = sqlite3.connect(db_path, check_same_thread=False, factory=Connection)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
     conn.execute("PRAGMA foreign_keys = ON")
     return conn
 
@@ -42,12 +67,228 @@ def get_conn(db_path: str) -> sqlite3.Connection:
 def init_db(db_path: str) -> None:
     with get_conn(db_path) as conn:
         conn.executescript(SCHEMA)
-        # Migrate existing DBs that predate the added_transactions column.
+        migrate(conn)
+
+
+# --- Migrations ---
+# Schema changes on top of SCHEMA. Each runs once, in its own transaction, and
+# PRAGMA user_version records how many have been applied. Append new ones to
+# MIGRATIONS; never edit or reorder those already shipped.
+
+def _add_added_transactions_column(conn: sqlite3.Connection) -> None:
+    # DBs created before added_transactions was part of SCHEMA lack it.
+    columns = {row['name'] for row in conn.execute("PRAGMA table_info(fetch_runs)")}
+    if 'added_transactions' not in columns:
+        conn.execute("ALTER TABLE fetch_runs ADD COLUMN added_transactions TEXT")
+
+
+def _add_query_indexes(conn: sqlite3.Connection) -> None:
+    # get_recent_runs
+    conn.execute("CREATE INDEX idx_fetch_runs_started_at ON fetch_runs(started_at)")
+    # get_runs_since
+    conn.execute(
+        """CREATE INDEX idx_fetch_runs_with_additions ON fetch_runs(started_at)
+           WHERE status = 'success' AND transactions_added > 0""")
+    # get_recently_added_transactions
+    conn.execute(
+        """CREATE INDEX idx_fetch_runs_added_transactions ON fetch_runs(started_at)
+           WHERE status = 'success' AND added_transactions IS NOT NULL""")
+    # get_emails_pending_parse
+    conn.execute(
+        """CREATE INDEX idx_emails_pending ON emails(downloaded_at)
+           WHERE parse_status IN ('pending', 'error')""")
+    # get_run_emails, reset_parsed_emails_for_run
+    conn.execute("CREATE INDEX idx_emails_fetch_run ON emails(fetch_run_id, downloaded_at)")
+
+
+def _add_run_log_table(conn: sqlite3.Connection) -> None:
+    # One row per log line instead of an ever-growing fetch_runs.log blob.
+    conn.execute(
+        """CREATE TABLE run_log (
+               id         INTEGER PRIMARY KEY,
+               run_id     INTEGER NOT NULL REFERENCES fetch_runs(id),
+               logged_at  TEXT NOT NULL,
+               level      TEXT NOT NULL DEFAULT 'info',  -- info | error
+               stage      TEXT,                          -- gmail | parse | dropbox
+               line       TEXT NOT NULL
+           )""")
+    conn.execute("CREATE INDEX idx_run_log_run ON run_log(run_id, id)")
+    runs = conn.execute(
+        "SELECT id, started_at, log FROM fetch_runs WHERE log != '' ORDER BY id").fetchall()
+    for run in runs:
+        conn.executemany(
+            "INSERT INTO run_log (run_id, logged_at, line) VALUES (?, ?, ?)",
+            [(run['id'], run['started_at'], line) for line in run['log'].splitlines()],
+        )
+    conn.execute("UPDATE fetch_runs SET log = '' WHERE log != ''")
+
+
+def _compress_raw_emails(conn: sqlite3.Connection) -> None:
+    # Store each message as zlib-compressed RFC 822 bytes instead of the
+    # base64url text Gmail returns. SQLite can't change a column's type, so
+    # the table is rebuilt; compress_raw runs inside the INSERT ... SELECT.
+    conn.create_function(
+        'compress_raw', 1, lambda text: pack_raw(base64.urlsafe_b64decode(text)),
+        deterministic=True)
+    conn.execute(
+        """CREATE TABLE emails_new (
+               gmail_id      TEXT PRIMARY KEY,
+               raw           BLOB NOT NULL,  -- zlib-compressed RFC 822 message
+               subject       TEXT,
+               from_addr     TEXT,
+               downloaded_at TEXT NOT NULL,
+               fetch_run_id  INTEGER REFERENCES fetch_runs(id),
+               parse_status  TEXT NOT NULL DEFAULT 'pending',  -- pending | parsed | error | skipped
+               parsed_at     TEXT,
+               parse_error   TEXT
+           )""")
+    conn.execute(
+        """INSERT INTO emails_new
+           SELECT gmail_id, compress_raw(raw_content), subject, from_addr, downloaded_at,
+                  fetch_run_id, parse_status, parsed_at, parse_error
+           FROM emails""")
+    conn.execute("DROP TABLE emails")
+    conn.execute("ALTER TABLE emails_new RENAME TO emails")
+    conn.execute(
+        """CREATE INDEX idx_emails_pending ON emails(downloaded_at)
+           WHERE parse_status IN ('pending', 'error')""")
+    conn.execute("CREATE INDEX idx_emails_fetch_run ON emails(fetch_run_id, downloaded_at)")
+
+
+_compress_raw_emails.vacuum = True  # give the space freed by the old bodies back to the OS
+
+
+def _add_gmail_id_to_pending_index(conn: sqlite3.Connection) -> None:
+    # iter_emails_pending_parse pages by (downloaded_at, gmail_id).
+    conn.execute("DROP INDEX idx_emails_pending")
+    conn.execute(
+        """CREATE INDEX idx_emails_pending ON emails(downloaded_at, gmail_id)
+           WHERE parse_status IN ('pending', 'error')""")
+
+
+def _add_parser_version_column(conn: sqlite3.Connection) -> None:
+    # Which parsers.BankFormat version produced each parsed email, so
+    # reset_stale_emails can re-parse only what a pattern fix affects.
+    # Emails parsed before this was recorded stay NULL and count as stale.
+    conn.execute("ALTER TABLE emails ADD COLUMN parser_version TEXT")
+
+
+def _add_transactions_table(conn: sqlite3.Connection) -> None:
+    # Parsed result of every successfully parsed email, written by the parse
+    # stage. Emails parsed before this table existed get their parser_version
+    # cleared so the next Re-parse (reset_stale_emails) fills their rows in.
+    conn.execute(
+        """CREATE TABLE transactions (
+               gmail_id       TEXT PRIMARY KEY REFERENCES emails(gmail_id),
+               date           TEXT NOT NULL,  -- YYYY-MM-DD
+               amount_cents   INTEGER NOT NULL,
+               description    TEXT NOT NULL,
+               source         TEXT NOT NULL,
+               original_line  TEXT NOT NULL,
+               parsed_at      TEXT NOT NULL
+           )""")
+    # get_transactions_between
+    conn.execute("CREATE INDEX idx_transactions_date ON transactions(date)")
+    conn.execute("UPDATE emails SET parser_version = NULL WHERE parse_status = 'parsed'")
+
+
+def _add_transactions_added_at(conn: sqlite3.Connection) -> None:
+    # When each transaction was last added to Dropbox, replacing the JSON
+    # lists in fetch_runs.added_transactions. Those lists are moved over
+    # (creating rows for emails parsed before the transactions table) and
+    # then emptied, and the fetch_runs indexes that served them dropped.
+    conn.execute("ALTER TABLE transactions ADD COLUMN added_at TEXT")
+    # get_recently_added_transactions, get_transactions_added_since
+    conn.execute(
+        """CREATE INDEX idx_transactions_added_at ON transactions(added_at)
+           WHERE added_at IS NOT NULL""")
+    conn.execute(
+        """INSERT INTO transactions
+               (gmail_id, date, amount_cents, description, source, original_line,
+                parsed_at, added_at)
+           SELECT id, date, amount_cents, description, source,
+                  COALESCE(original_line, id), started_at, started_at
+           FROM (SELECT json_extract(t.value, '$.id') AS id,
+                        json_extract(t.value, '$.date') AS date,
+                        json_extract(t.value, '$.amount_cents') AS amount_cents,
+                        json_extract(t.value, '$.description') AS description,
+                        json_extract(t.value, '$.source') AS source,
+                        json_extract(t.value, '$.original_line') AS original_line,
+                        r.started_at
+                 FROM fetch_runs r, json_each(r.added_transactions) t
+                 WHERE r.status = 'success' AND r.added_transactions IS NOT NULL)
+           WHERE id IN (SELECT gmail_id FROM emails)
+           ON CONFLICT(gmail_id) DO UPDATE
+           SET added_at = MAX(COALESCE(added_at, ''), excluded.added_at)""")
+    conn.execute("UPDATE fetch_runs SET added_transactions = NULL WHERE added_transactions IS NOT NULL")
+    conn.execute("DROP INDEX IF EXISTS idx_fetch_runs_with_additions")
+    conn.execute("DROP INDEX IF EXISTS idx_fetch_runs_added_transactions")
+
+
+def _add_run_metrics_table(conn: sqlite3.Connection) -> None:
+    # Per-run timers and counters from metrics.RunMetrics, one row per name.
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS run_metrics (
+               run_id  INTEGER NOT NULL REFERENCES fetch_runs(id),
+               name    TEXT NOT NULL,  -- a metrics.TIMERS or metrics.COUNTERS name
+               value   REAL NOT NULL,  -- seconds for timers
+               PRIMARY KEY (run_id, name)
+           ) WITHOUT ROWID""")
+
+
+MIGRATIONS = [
+    _add_added_transactions_column,
+    _add_query_indexes,
+    _add_run_log_table,
+    _compress_raw_emails,
+    _add_gmail_id_to_pending_index,
+    _add_parser_version_column,
+    _add_transactions_table,
+    _add_transactions_added_at,
+    _add_run_metrics_table,
+]
+
+
+def migrate(conn: sqlite3.Connection) -> None:
+    """Apply any MIGRATIONS newer than the DB's user_version.
+
+    A migration with a truthy `vacuum` attribute gets a VACUUM once all are
+    applied (it can't run inside their transactions).
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    vacuum = False
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN")
         try:
-            conn.execute("ALTER TABLE fetch_runs ADD COLUMN added_transactions TEXT")
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
             conn.commit()
-        except sqlite3.OperationalError:
-            pass
+        except BaseException:
+            conn.rollback()
+            raise
+        vacuum = vacuum or getattr(migration, 'vacuum', False)
+    if vacuum:
+        conn.execute("VACUUM")
+
+
+@contextmanager
+def transaction(conn: sqlite3.Connection):
+    """Unit of work: helpers called inside the block share a single commit.
+
+    Blocks may nest; only the outermost one commits, or rolls back if the
+    block raises.
+    """
+    conn._transaction_depth += 1
+    try:
+        yield conn
+    except BaseException:
+        conn._transaction_depth -= 1
+        if not conn._transaction_depth:
+            conn.rollback()
+        raise
+    conn._transaction_depth -= 1
+    if not conn._transaction_depth:
+        conn.commit()
 
 
 # --- Runs ---
@@ -55,16 +296,41 @@ def init_db(db_path: str) -> None:
 def start_run(conn: sqlite3.Connection) -> int:
     now = _now()
     cur = conn.execute("INSERT INTO fetch_runs (started_at) VALUES (?)", (now,))
-    conn.commit()
+    _commit(conn)
     return cur.lastrowid
 
 
-def append_log(conn: sqlite3.Connection, run_id: int, line: str) -> None:
-    conn.execute(
-        "UPDATE fetch_runs SET log = log || ? WHERE id = ?",
-        (line + "\n", run_id),
+def append_log(
+    conn: sqlite3.Connection,
+    run_id: int,
+    line: str,
+    level: str = 'info',
+    stage: Optional[str] = None,
+) -> None:
+    append_log_many(conn, run_id, [(_now(), level, stage, line)])
+
+
+def append_log_many(conn: sqlite3.Connection, run_id: int, entries: list) -> None:
+    """Insert (logged_at, level, stage, line) tuples for a run in one statement batch."""
+    conn.executemany(
+        "INSERT INTO run_log (run_id, logged_at, level, stage, line) VALUES (?, ?, ?, ?, ?)",
+        [(run_id, *e) for e in entries],
     )
-    conn.commit()
+    _commit(conn)
+
+
+def get_run_log(conn: sqlite3.Connection, run_id: int, offset: int = 0, limit: int = 500) -> list:
+    return conn.execute(
+        """SELECT logged_at, level, stage, line FROM run_log
+           WHERE run_id = ? ORDER BY id LIMIT ? OFFSET ?""",
+        (run_id, limit, offset),
+    ).fetchall()
+
+
+def count_run_log(conn: sqlite3.Connection, run_id: int) -> int:
+    return conn.execute(
+        "SELECT COUNT(*) FROM run_log WHERE run_id = ?", (run_id,)
+    ).fetchone()[0]
 
 
 def finish_run(
@@ -74,51 +340,120 @@ def finish_run(
     emails_downloaded: int = 0,
     emails_parsed: int = 0,
     transactions_added: int = 0,
-    added_transactions: Optional[list] = None,
 ) -> None:
-    import json
     conn.execute(
         """UPDATE fetch_runs
            SET finished_at = ?, status = ?,
-               emails_downloaded = ?, emails_parsed = ?, transactions_added = ?,
-               added_transactions = ?
+               emails_downloaded = ?, emails_parsed = ?, transactions_added = ?
            WHERE id = ?""",
-        (_now(), status, emails_downloaded, emails_parsed, transactions_added,
-         json.dumps(added_transactions) if added_transactions else None, run_id),
+        (_now(), status, emails_downloaded, emails_parsed, transactions_added, run_id),
+    )
+    _commit(conn)
+
+
+def fail_interrupted_runs(conn: sqlite3.Connection) -> int:
+    """Mark runs still 'running' as errors; returns how many.
+
+    For server startup, when no run can be in progress: such rows were left
+    by a process that stopped mid-run (a restart or power loss).
+    """
+    with transaction(conn):
+        run_ids = [row[0] for row in conn.execute(
+            "SELECT id FROM fetch_runs WHERE status = 'running'")]
+        now = _now()
+        for run_id in run_ids:
+            append_log_many(conn, run_id, [(now, 'error', None,
+                                            'Server stopped before this run finished')])
+        conn.execute(
+            "UPDATE fetch_runs SET status = 'error', finished_at = ? WHERE status = 'running'",
+            (now,))
+    return len(run_ids)
+
+
+def save_run_metrics(conn: sqlite3.Connection, run_id: int, values: dict) -> None:
+    conn.executemany(
+        "INSERT OR REPLACE INTO run_metrics (run_id, name, value) VALUES (?, ?, ?)",
+        [(run_id, name, value) for name, value in values.items()],
+    )
+    _commit(conn)
+
+
+def get_run_metrics(conn: sqlite3.Connection, run_id: int) -> dict:
+    return dict(conn.execute(
+        "SELECT name, value FROM run_metrics WHERE run_id = ?", (run_id,)).fetchall())
+
+
+def mark_transactions_added(conn: sqlite3.Connection, gmail_ids: list) -> None:
+    """Record that these transactions were just added to Dropbox."""
+    now = _now()
+    conn.executemany(
+        "UPDATE transactions SET added_at = ? WHERE gmail_id = ?",
+        [(now, gmail_id) for gmail_id in gmail_ids],
     )
-    conn.commit()
+    _commit(conn)
+
+
+def get_transactions_added_since(conn: sqlite3.Connection, since_iso: str) -> list:
+    """Transactions added to Dropbox at or after since_iso, oldest addition first."""
+    rows = conn.execute(
+        """SELECT gmail_id, date, amount_cents, description, source, original_line
+           FROM transactions WHERE added_at >= ? ORDER BY added_at""",
+        (since_iso,),
+    ).fetchall()
+    return [transaction_from_row(row) for row in rows]
 
 
 def get_recently_added_transactions(conn: sqlite3.Connection, days: int = 7) -> list:
-    """Return deduplicated transactions added by successful runs in the last `days` days.
+    """Return transactions added to Dropbox in the last `days` days.
 
     Used by the pipeline to re-include recent additions so that any lost due to
     a stale frontend save are restored on the next run.
     """
-    import json
     cutoff = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
-    rows = conn.execute(
-        """SELECT added_transactions FROM fetch_runs
-           WHERE status = 'success' AND started_at >= ? AND added_transactions IS NOT NULL
-           ORDER BY started_at DESC""",
-        (cutoff,),
-    ).fetchall()
-    seen_ids: set = set()
-    result = []
-    for row in rows:
-        for t in json.loads(row[0]):
-            if t['id'] not in seen_ids:
-                seen_ids.add(t['id'])
-                result.append(t)
-    return result
-
-
-def get_recent_runs(conn: sqlite3.Connection, days: int = 7) -> list:
-    since = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
-    return conn.execute(
-        "SELECT * FROM fetch_runs WHERE started_at >= ? ORDER BY started_at DESC",
-        (since,),
-    ).fetchall()
+    return get_transactions_added_since(conn, cutoff)
+
+
+# Summary columns of the run list, with duration in whole seconds (NULL while
+# running). julianday() differences are a little off in floating point, so
+# they are rounded to the millisecond before truncating, or exact-second
+# durations can come out a second short.
+_RUN_SUMMARY = """
+    SELECT id, started_at, finished_at, status,
+           emails_downloaded, emails_parsed, transactions_added,
+           CAST(ROUND((julianday(finished_at) - julianday(started_at)) * 86400, 3) AS INTEGER)
+               AS duration_seconds
+    FROM fetch_runs"""
+
+
+def get_runs_page(conn: sqlite3.Connection, limit: int = 50,
+                  before_id: Optional[int] = None, after_id: Optional[int] = None) -> tuple:
+    """One page of run summaries, newest first: (runs, has_more).
+
+    Keyset pagination on (started_at, id), served by idx_fetch_runs_started_at
+    (which ends in the rowid): before_id pages to runs older than that run,
+    after_id to runs newer than it. has_more says whether further
+    runs exist in the direction paged (older ones when neither is given).
+    """
+    if after_id is not None:
+        rows = conn.execute(
+            _RUN_SUMMARY + """
+            WHERE (started_at, id) > (SELECT started_at, id FROM fetch_runs WHERE id = ?)
+            ORDER BY started_at, id LIMIT ?""",
+            (after_id, limit + 1),
+        ).fetchall()
+        return rows[:limit][::-1], len(rows) > limit
+    if before_id is not None:
+        rows = conn.execute(
+            _RUN_SUMMARY + """
+            WHERE (started_at, id) < (SELECT started_at, id FROM fetch_runs WHERE id = ?)
+            ORDER BY started_at DESC, id DESC LIMIT ?""",
+            (before_id, limit + 1),
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            _RUN_SUMMARY + " ORDER BY started_at DESC, id DESC LIMIT ?", (limit + 1,),
+        ).fetchall()
+    return rows[:limit], len(rows) > limit
 
 
 def get_run(conn: sqlite3.Connection, run_id: int):
@@ -129,67 +464,162 @@ def get_run(conn: sqlite3.Connection, run_id: int):
 
 # --- Emails ---
 
-def is_email_seen(conn: sqlite3.Connection, gmail_id: str) -> bool:
-    return conn.execute(
-        "SELECT 1 FROM emails WHERE gmail_id = ?", (gmail_id,)
-    ).fetchone() is not None
+def seen_email_ids(conn: sqlite3.Connection, gmail_ids: list) -> set:
+    """Subset of gmail_ids already stored, in a single query."""
+    if not gmail_ids:
+        return set()
+    placeholders = ','.join('?' * len(gmail_ids))
+    rows = conn.execute(
+        f"SELECT gmail_id FROM emails WHERE gmail_id IN ({placeholders})", list(gmail_ids)
+    ).fetchall()
+    return {row[0] for row in rows}
 
 
 def save_email(
     conn: sqlite3.Connection,
     gmail_id: str,
-    raw_content: str,
+    raw: bytes,
     subject: Optional[str],
     from_addr: Optional[str],
     fetch_run_id: int,
 ) -> None:
-    conn.execute(
+    save_emails_many(conn, [(gmail_id, raw, subject, from_addr)], fetch_run_id)
+
+
+def save_emails_many(conn: sqlite3.Connection, emails: list, fetch_run_id: int) -> None:
+    """Insert (gmail_id, raw, subject, from_addr) tuples in one transaction.
+
+    raw is the RFC 822 message as bytes; it is stored compressed (see pack_raw).
+    """
+    now = _now()
+    conn.executemany(
         """INSERT INTO emails
-               (gmail_id, raw_content, subject, from_addr, downloaded_at, fetch_run_id)
+               (gmail_id, raw, subject, from_addr, downloaded_at, fetch_run_id)
            VALUES (?, ?, ?, ?, ?, ?)""",
-        (gmail_id, raw_content, subject, from_addr, _now(), fetch_run_id),
+        [(gmail_id, pack_raw(raw), subject, from_addr, now, fetch_run_id)
+         for gmail_id, raw, subject, from_addr in emails],
     )
-    conn.commit()
+    _commit(conn)
 
 
-def mark_email_parsed(conn: sqlite3.Connection, gmail_id: str) -> None:
-    conn.execute(
-        "UPDATE emails SET parse_status = 'parsed', parsed_at = ? WHERE gmail_id = ?",
-        (_now(), gmail_id),
+def mark_parsed_many(conn: sqlite3.Connection, parsed: list) -> None:
+    """parsed: [(gmail_id, parser_version)]"""
+    now = _now()
+    conn.executemany(
+        "UPDATE emails SET parse_status = 'parsed', parsed_at = ?, parser_version = ? "
+        "WHERE gmail_id = ?",
+        [(now, parser_version, gmail_id) for gmail_id, parser_version in parsed],
     )
-    conn.commit()
+    _commit(conn)
 
 
-def mark_email_error(conn: sqlite3.Connection, gmail_id: str, error: str) -> None:
-    conn.execute(
+def mark_errors_many(conn: sqlite3.Connection, errors: list) -> None:
+    """Record (gmail_id, error) pairs."""
+    now = _now()
+    conn.executemany(
         "UPDATE emails SET parse_status = 'error', parsed_at = ?, parse_error = ? WHERE gmail_id = ?",
-        (_now(), error, gmail_id),
+        [(now, error, gmail_id) for gmail_id, error in errors],
     )
-    conn.commit()
+    _commit(conn)
 
 
-def get_emails_pending_parse(conn: sqlite3.Connection) -> list:
-    """All emails not yet successfully parsed — used for initial parse and re-parse."""
-    return conn.execute(
-        "SELECT * FROM emails WHERE parse_status IN ('pending', 'error') ORDER BY downloaded_at"
+def save_transactions_many(conn: sqlite3.Connection, transactions: list) -> None:
+    """Insert or update parsed transaction dicts (as built by parsers.BankFormat).
+
+    Re-parsing an email updates its row in place, keeping added_at.
+    """
+    now = _now()
+    conn.executemany(
+        """INSERT INTO transactions
+               (gmail_id, date, amount_cents, description, source, original_line, parsed_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?)
+           ON CONFLICT(gmail_id) DO UPDATE
+           SET date = excluded.date, amount_cents = excluded.amount_cents,
+               description = excluded.description, source = excluded.source,
+               original_line = excluded.original_line, parsed_at = excluded.parsed_at""",
+        [(t['id'], t['date'], t['amount_cents'], t['description'], t['source'],
+          t['original_line'], now) for t in transactions],
+    )
+    _commit(conn)
+
+
+def delete_transactions(conn: sqlite3.Connection, gmail_ids: list) -> None:
+    conn.executemany("DELETE FROM transactions WHERE gmail_id = ?", [(i,) for i in gmail_ids])
+    _commit(conn)
+
+
+def get_transactions_between(conn: sqlite3.Connection, start_date: str, end_date: str) -> list:
+    """Parsed transactions dated start_date..end_date (inclusive, YYYY-MM-DD), newest first."""
+    rows = conn.execute(
+        """SELECT gmail_id, date, amount_cents, description, source, original_line
+           FROM transactions WHERE date BETWEEN ? AND ? ORDER BY date DESC""",
+        (start_date, end_date),
     ).fetchall()
+    return [transaction_from_row(row) for row in rows]
+
+
+def transaction_from_row(row) -> dict:
+    """Rebuild the transactions.json entry for a transactions table row."""
+    return {
+        'id': row['gmail_id'],
+        'description': row['description'],
+        'original_line': row['original_line'],
+        'date': row['date'],
+        'tags': [],
+        'amount_cents': row['amount_cents'],
+        'transactions': [],
+        'source': row['source'],
+        'notes': '',
+    }
+
+
+def count_emails_pending_parse(conn: sqlite3.Connection) -> int:
+    return conn.execute(
+        "SELECT COUNT(*) FROM emails WHERE parse_status IN ('pending', 'error')"
+    ).fetchone()[0]
+
+
+def iter_emails_pending_parse(conn: sqlite3.Connection, chunk_size: int = 500):
+    """Emails not yet successfully parsed (pending or in error), oldest
+    download first, in lists of at most chunk_size rows.
+
+    Rows hold gmail_id and the still-compressed raw; see unpack_raw. Pages
+    by (downloaded_at, gmail_id) rather than holding a cursor open, so
+    callers can update parse_status between chunks; rows that stay in error
+    are not revisited.
+    """
+    last = ('', '')
+    while True:
+        chunk = conn.execute(
+            """SELECT gmail_id, raw, downloaded_at FROM emails
+               WHERE parse_status IN ('pending', 'error') AND (downloaded_at, gmail_id) > (?, ?)
+               ORDER BY downloaded_at, gmail_id LIMIT ?""",
+            (*last, chunk_size),
+        ).fetchall()
+        if not chunk:
+            return
+        yield chunk
+        last = (chunk[-1]['downloaded_at'], chunk[-1]['gmail_id'])
 
 
 def get_run_emails(conn: sqlite3.Connection, run_id: int) -> list:
     return conn.execute(
-        "SELECT * FROM emails WHERE fetch_run_id = ? ORDER BY downloaded_at",
+        """SELECT e.gmail_id, e.subject, e.from_addr, e.downloaded_at, e.fetch_run_id,
+                  e.parse_status, e.parsed_at, e.parse_error,
+                  t.date, t.amount_cents, t.description
+           FROM emails e LEFT JOIN transactions t ON t.gmail_id = e.gmail_id
+           WHERE e.fetch_run_id = ? ORDER BY e.downloaded_at""",
         (run_id,),
     ).fetchall()
 
 
-def get_runs_since(conn: sqlite3.Connection, since_iso: str) -> list:
-    """Returns runs that finished successfully since since_iso with at least one transaction."""
-    return conn.execute(
-        """SELECT * FROM fetch_runs
-           WHERE started_at >= ? AND status = 'success' AND transactions_added > 0
-           ORDER BY started_at""",
-        (since_iso,),
-    ).fetchall()
+def pack_raw(raw: bytes) -> bytes:
+    """Storage format of emails.raw: zlib-compressed RFC 822 bytes."""
+    return zlib.compress(raw, 6)
+
+
+def unpack_raw(blob: bytes) -> bytes:
+    return zlib.decompress(blob)
 
 
 def reset_parsed_emails(conn: sqlite3.Connection) -> int:
@@ -199,7 +629,21 @@ def reset_parsed_emails(conn: sqlite3.Connection) -> int:
         "UPDATE emails SET parse_status = 'pending', parsed_at = NULL, parse_error = NULL "
         "WHERE parse_status = 'parsed'"
     )
-    conn.commit()
+    _commit(conn)
+    return cur.rowcount
+
+
+def reset_stale_emails(conn: sqlite3.Connection, current_versions: list) -> int:
+    """Mark emails in error, and parsed emails whose parser_version isn't one
+    of current_versions, back to pending. Returns the number reset."""
+    placeholders = ', '.join('?' * len(current_versions))
+    cur = conn.execute(
+        "UPDATE emails SET parse_status = 'pending', parsed_at = NULL, parse_error = NULL "
+        "WHERE parse_status = 'error' OR (parse_status = 'parsed' AND "
+        f"(parser_version IS NULL OR parser_version NOT IN ({placeholders})))",
+        current_versions,
+    )
+    _commit(conn)
     return cur.rowcount
 
 
@@ -210,11 +654,38 @@ def reset_parsed_emails_for_run(conn: sqlite3.Connection, run_id: int) -> int:
         "WHERE fetch_run_id = ? AND parse_status IN ('parsed', 'error', 'skipped')",
         (run_id,),
     )
-    conn.commit()
+    _commit(conn)
     return cur.rowcount
 
 
+# --- Sync state ---
+
+def get_sync_state(conn: sqlite3.Connection, key: str) -> Optional[str]:
+    row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set_sync_state(conn: sqlite3.Connection, key: str, value: str) -> None:
+    conn.execute(
+        """INSERT INTO sync_state (key, value, updated_at) VALUES (?, ?, ?)
+           ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at""",
+        (key, value, _now()),
+    )
+    _commit(conn)
+
+
+def delete_sync_state(conn: sqlite3.Connection, key: str) -> None:
+    conn.execute("DELETE FROM sync_state WHERE key = ?", (key,))
+    _commit(conn)
+
+
 # --- Internal ---
 
+def _commit(conn: sqlite3.Connection) -> None:
+    """Commit now unless inside transaction(), which commits once at the end."""
+    if not getattr(conn, '_transaction_depth', 0):
+        conn.commit()
+
+
 def _now() -> str:
     return datetime.now(timezone.utc).isoformat()
@@ -0,0 +1,286 @@
+"""
+In-memory stand-ins for the external APIs the pipeline talks to, so the sync
+logic can be exercised offline by tests.
+
+FakeGmailService mimics the subset of the googleapiclient Gmail resource that
+pipeline.py uses: service.users().messages().list/get/send(...).execute(),
+service.users().history().list(...).execute(),
+service.users().getProfile(...).execute() and
+service.new_batch_http_request(...). An optional per-round-trip latency makes
+it usable for benchmarks too (see bench.py).
+
+FakeDropbox does the same for the dropbox.Dropbox client methods used by
+sync_to_dropbox, returning real dropbox.files types.
+"""
+import base64
+import hashlib
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Optional
+
+import httplib2
+from dropbox import files as dropbox_files
+from dropbox.exceptions import ApiError
+from googleapiclient.errors import HttpError
+
+
+def http_error(status: int, reason: str = '') -> HttpError:
+    """Build an HttpError shaped like the ones googleapiclient raises."""
+    resp = httplib2.Response({'status': status, 'reason': reason})
+    return HttpError(resp, reason.encode())
+
+
+class _Request:
+    """Deferred API call, executed (and counted) on .execute()."""
+    def __init__(self, service, name: str, fn):
+        self._service = service
+        self._name = name
+        self._fn = fn
+
+    def execute(self):
+        time.sleep(self._service.latency)
+        return self._call()
+
+    def _call(self):
+        self._service.calls[self._name] += 1
+        return self._fn()
+
+
+class _BatchRequest:
+    """Batch of requests sent in one round-trip; mirrors googleapiclient's BatchHttpRequest."""
+    MAX_REQUESTS = 100  # Gmail rejects larger batches
+
+    def __init__(self, service, callback):
+        self._service = service
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        if len(self._requests) >= self.MAX_REQUESTS:
+            raise ValueError(f'Gmail batches are limited to {self.MAX_REQUESTS} requests')
+        request_id = request_id or str(len(self._requests) + 1)
+        self._requests.append((request_id, request, callback or self._callback))
+
+    def execute(self):
+        time.sleep(self._service.latency)
+        self._service.calls['batch'] += 1
+        for request_id, request, callback in self._requests:
+            try:
+                response, exception = request._call(), None
+            except HttpError as e:
+                response, exception = None, e
+            callback(request_id, response, exception)
+
+
+class FakeGmailService:
+    """Gmail mailbox held in memory.
+
+    Messages are added with add_message(); every addition bumps the mailbox
+    history ID and records a messageAdded history entry. delete_message()
+    removes one but keeps that entry, so it is still listed while
+    messages.get 404s. expire_history() makes every history ID issued so far
+    too old, so history().list raises a 404 exactly like Gmail does once a
+    startHistoryId falls out of retention.
+    `calls` counts executed requests by method name, e.g. calls['messages.get'].
+    IDs in `failing_ids` make messages.get fail with a 500, and page tokens in
+    `failing_page_tokens` do the same for messages.list. Every round-trip
+    (single request or whole batch) sleeps for `latency` seconds.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self._messages = {}      # gmail_id -> {'raw', 'labelIds', 'historyId'}
+        self._order = []         # gmail_ids, oldest first
+        self._history = []       # [(history_id, gmail_id, label_ids)]
+        self._history_id = 1000
+        self._min_history_id = 0
+        self.sent = []
+        self.calls = Counter()
+        self.failing_ids = set()
+        self.failing_page_tokens = set()
+
+    # ── Mailbox setup ─────────────────────────────────────────────────────────
+
+    def add_message(self, raw: bytes, label_ids: list, gmail_id: Optional[str] = None) -> str:
+        """Deliver an RFC 822 message (as bytes) to the mailbox; returns its ID."""
+        self._history_id += 1
+        gmail_id = gmail_id or f'msg{self._history_id:x}'
+        self._messages[gmail_id] = {
+            'raw': base64.urlsafe_b64encode(raw).decode(),
+            'labelIds': list(label_ids),
+            'historyId': str(self._history_id),
+        }
+        self._order.append(gmail_id)
+        self._history.append((self._history_id, gmail_id, list(label_ids)))
+        return gmail_id
+
+    def delete_message(self, gmail_id: str) -> None:
+        del self._messages[gmail_id]
+        self._order.remove(gmail_id)
+
+    def expire_history(self) -> None:
+        self._min_history_id = self._history_id + 1
+
+    # ── API surface ───────────────────────────────────────────────────────────
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return _Messages(self)
+
+    def history(self):
+        return _History(self)
+
+    def new_batch_http_request(self, callback=None):
+        return _BatchRequest(self, callback)
+
+    def getProfile(self, userId):
+        return _Request(self, 'getProfile', lambda: {
+            'emailAddress': 'me@example.com',
+            'historyId': str(self._history_id),
+        })
+
+
+class _Messages:
+    def __init__(self, service: FakeGmailService):
+        self._s = service
+
+    def list(self, userId, labelIds=None, maxResults=100, pageToken=None):
+        def _list():
+            if pageToken in self._s.failing_page_tokens:
+                raise http_error(500, 'Backend Error')
+            ids = [i for i in reversed(self._s._order)
+                   if not labelIds or set(labelIds) <= set(self._s._messages[i]['labelIds'])]
+            start = int(pageToken or 0)
+            page = ids[start:start + maxResults]
+            result = {'resultSizeEstimate': len(ids)}
+            if page:
+                result['messages'] = [{'id': i, 'threadId': i} for i in page]
+            if start + maxResults < len(ids):
+                result['nextPageToken'] = str(start + maxResults)
+            return result
+        return _Request(self._s, 'messages.list', _list)
+
+    def get(self, userId, id, format='full'):
+        def _get():
+            if id in self._s.failing_ids:
+                raise http_error(500, 'Backend Error')
+            if id not in self._s._messages:
+                raise http_error(404, 'Requested entity was not found.')
+            m = self._s._messages[id]
+            return {'id': id, 'threadId': id, 'labelIds': m['labelIds'],
+                    'historyId': m['historyId'], 'raw': m['raw']}
+        return _Request(self._s, 'messages.get', _get)
+
+    def send(self, userId, body):
+        def _send():
+            self._s.sent.append(body)
+            return {'id': f'sent{len(self._s.sent)}'}
+        return _Request(self._s, 'messages.send', _send)
+
+
+class _History:
+    def __init__(self, service: FakeGmailService):
+        self._s = service
+
+    def list(self, userId, startHistoryId, labelId=None, historyTypes=None,
+             maxResults=100, pageToken=None):
+        def _list():
+            if int(startHistoryId) < self._s._min_history_id:
+                raise http_error(404, 'Requested entity was not found.')
+            records = [
+                {'id': str(h), 'messagesAdded': [{'message': {
+                    'id': gmail_id, 'threadId': gmail_id, 'labelIds': labels}}]}
+                for h, gmail_id, labels in self._s._history
+                if h > int(startHistoryId) and (labelId is None or labelId in labels)
+            ]
+            start = int(pageToken or 0)
+            result = {'historyId': str(self._s._history_id)}
+            if records[start:start + maxResults]:
+                result['history'] = records[start:start + maxResults]
+            if start + maxResults < len(records):
+                result['nextPageToken'] = str(start + maxResults)
+            return result
+        return _Request(self._s, 'history.list', _list)
+
+
+# ── Dropbox ───────────────────────────────────────────────────────────────────
+
+def dropbox_content_hash(data: bytes) -> str:
+    """Dropbox's content_hash: SHA-256 over the SHA-256 of each 4MB block."""
+    block = 4 * 1024 * 1024
+    digests = b''.join(hashlib.sha256(data[i:i + block]).digest()
+                       for i in range(0, len(data), block))
+    return hashlib.sha256(digests).hexdigest()
+
+
+class _Download:
+    """The part of the requests.Response returned by files_download that we read."""
+    def __init__(self, content: bytes):
+        self.content = content
+
+
+class FakeDropbox:
+    """Dropbox account held in memory.
+
+    Implements files_get_metadata, files_download and files_upload with the
+    dropbox.Dropbox signatures, return types and errors, including the
+    conflict an upload in WriteMode.update(rev) gets once the file has moved
+    past rev. put() writes a file the way another client (e.g. the tracker
+    frontend) would; each (path, bytes) in `concurrent_writes` is put() just
+    before the next files_upload, as if that client had saved between our
+    download and upload. Every write gets a new rev; `calls` counts requests
+    by method name.
+    """
+
+    def __init__(self):
+        self._files = {}  # path -> (FileMetadata, bytes)
+        self._revs = 0
+        self.calls = Counter()
+        self.concurrent_writes = []
+
+    def put(self, path: str, data: bytes) -> dropbox_files.FileMetadata:
+        self._revs += 1
+        name = path.rsplit('/', 1)[-1]
+        metadata = dropbox_files.FileMetadata(
+            name=name, id=f'id:{name}', rev=f'{self._revs:09x}', size=len(data),
+            client_modified=datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0),
+            server_modified=datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0),
+            path_lower=path.lower(), path_display=path, content_hash=dropbox_content_hash(data),
+        )
+        self._files[path.lower()] = (metadata, data)
+        return metadata
+
+    def read(self, path: str) -> bytes:
+        return self._files[path.lower()][1]
+
+    def _lookup(self, path: str, error=dropbox_files.GetMetadataError):
+        if path.lower() not in self._files:
+            raise ApiError('fake-request', error.path(dropbox_files.LookupError.not_found),
+                           None, None)
+        return self._files[path.lower()]
+
+    # ── API surface ───────────────────────────────────────────────────────────
+
+    def files_get_metadata(self, path: str, **kwargs) -> dropbox_files.FileMetadata:
+        self.calls['files_get_metadata'] += 1
+        return self._lookup(path)[0]
+
+    def files_download(self, path: str, rev: Optional[str] = None):
+        self.calls['files_download'] += 1
+        metadata, data = self._lookup(path, dropbox_files.DownloadError)
+        return metadata, _Download(data)
+
+    def files_upload(self, f: bytes, path: str, mode=dropbox_files.WriteMode.add, **kwargs):
+        self.calls['files_upload'] += 1
+        if self.concurrent_writes:
+            self.put(*self.concurrent_writes.pop(0))
+        current = self._files.get(path.lower())
+        if ((mode.is_add() and current is not None)
+                or (mode.is_update() and (current is None or current[0].rev != mode.get_update()))):
+            raise ApiError('fake-request', dropbox_files.UploadError.path(dropbox_files.UploadWriteFailed(
+                reason=dropbox_files.WriteError.conflict(dropbox_files.WriteConflictError.file),
+                upload_session_id='')), None, None)
+        return self.put(path, f)
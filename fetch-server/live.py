@@ -0,0 +1,66 @@
+"""In-memory fan-out of the current run's log to /run/{run_id}/events subscribers."""
+import asyncio
+import collections
+import threading
+from typing import Optional
+
+
+class LiveLog:
+    """Log lines and stage changes of the run in progress, pushed to async subscribers.
+
+    publish() is passed to pipeline.run as its on_event callback and is called
+    from the pipeline thread; each subscriber's asyncio.Queue is fed through
+    its event loop, so streaming a run never reads SQLite. The latest BACKLOG
+    events are kept so a subscriber connecting mid-run first gets the lines
+    its page was rendered without (RunLogger only writes them in batches).
+    """
+    BACKLOG = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._run_id = None
+        self._backlog = collections.deque(maxlen=self.BACKLOG)
+        self._subscribers = set()  # (run_id, loop, queue)
+
+    def publish(self, run_id: int, event: dict) -> None:
+        with self._lock:
+            if run_id != self._run_id:
+                self._run_id = run_id
+                self._backlog.clear()
+            self._backlog.append(event)
+            queues = [(loop, queue) for r, loop, queue in self._subscribers if r == run_id]
+        for loop, queue in queues:
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    async def subscribe(self, run_id: int, after: int = 0, keepalive: Optional[float] = None):
+        """Yield run_id's events, skipping log lines numbered below `after`,
+        until its 'end' event. Yields None after `keepalive` idle seconds.
+
+        Yields nothing if run_id is not the run being published.
+        """
+        queue = asyncio.Queue()
+        subscriber = (run_id, asyncio.get_running_loop(), queue)
+        with self._lock:
+            if run_id != self._run_id:
+                return
+            backlog = list(self._backlog)
+            self._subscribers.add(subscriber)
+        try:
+            for event in backlog:
+                if event['type'] == 'line' and event['n'] < after:
+                    continue
+                yield event
+                if event['type'] == 'end':
+                    return
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                yield event
+                if event['type'] == 'end':
+                    return
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscriber)
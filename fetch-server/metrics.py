@@ -0,0 +1,227 @@
+"""
+Per-run performance figures: where a fetch run spent its time and how much it
+asked of Gmail, Dropbox and SQLite.
+
+pipeline.run() records into a RunMetrics for its duration (see recording());
+the pipeline stages call timer() and add() here, which do nothing when no run
+is recording, e.g. when a test calls a stage directly. db.save_run_metrics
+stores the result in run_metrics, and the run page shows it.
+
+Each finished run is also folded into the process-wide Counter and Histogram
+totals below, which the server's /metrics serves in the Prometheus text
+format. A scrape only formats what is already in memory.
+"""
+import collections
+import math
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# (name, label) in display order. Timers are seconds; the rest are counts.
+TIMERS = [
+    ('gmail_list', 'Gmail list'),
+    ('gmail_get', 'Gmail get'),
+    ('sqlite_save', 'SQLite save'),
+    ('parse', 'Parse'),
+    ('dropbox_download', 'Dropbox download'),
+    ('merge', 'Merge'),
+    ('dropbox_upload', 'Dropbox upload'),
+]
+COUNTERS = [
+    ('gmail_calls', 'Gmail round-trips'),
+    ('gmail_bytes', 'Gmail bytes downloaded'),
+    ('dropbox_calls', 'Dropbox calls'),
+    ('dropbox_bytes_down', 'Dropbox bytes downloaded'),
+    ('dropbox_bytes_up', 'Dropbox bytes uploaded'),
+    ('sqlite_statements', 'SQLite statements'),
+]
+LABELS = dict(TIMERS + COUNTERS)
+
+
+class RunMetrics:
+    """Seconds spent in each timer and totals of each counter for one run."""
+
+    def __init__(self):
+        self.values = collections.Counter()
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.values[name] += time.perf_counter() - start
+
+    def add(self, name: str, n: int = 1) -> None:
+        self.values[name] += n
+
+
+_local = threading.local()
+
+
+@contextmanager
+def recording(conn: sqlite3.Connection):
+    """Make a new RunMetrics this thread's current one, counting every SQL
+    statement conn executes meanwhile; yields it."""
+    metrics = RunMetrics()
+    _local.current = metrics
+    conn.set_trace_callback(lambda sql: metrics.add('sqlite_statements'))
+    start = time.perf_counter()
+    status = 'error'
+    try:
+        yield metrics
+        status = 'success'
+    finally:
+        conn.set_trace_callback(None)
+        _local.current = None
+        _fold(metrics, status, time.perf_counter() - start)
+
+
+def timer(name: str):
+    metrics = getattr(_local, 'current', None)
+    return metrics.timer(name) if metrics is not None else nullcontext()
+
+
+def add(name: str, n: int = 1) -> None:
+    metrics = getattr(_local, 'current', None)
+    if metrics is not None:
+        metrics.add(name, n)
+
+
+# ── Prometheus exposition ─────────────────────────────────────────────────────
+
+_families = []  # every Counter and Histogram, in definition order
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(pairs) -> str:
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Family:
+    kind = None
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values tuple -> value
+        self._lock = threading.Lock()
+        _families.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} takes labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def lines(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._samples(list(zip(self.labelnames, key)), value))
+        return lines
+
+
+class Counter(_Family):
+    """Monotonic total, optionally split by labels: c.inc(2, status='ok')."""
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        super().__init__(name, help, labelnames)
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self, pairs: list, value: float) -> list:
+        return [f'{self.name}{_format_labels(pairs)} {_format_value(value)}']
+
+
+class Histogram(_Family):
+    """Observations counted into cumulative `le` buckets, plus their sum and count."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=()):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = counts, total + value
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+            return counts[-1]
+
+    def _samples(self, pairs: list, value: tuple) -> list:
+        counts, total = value
+        lines = [f'{self.name}_bucket{_format_labels(pairs + [("le", _format_value(bound))])} {count}'
+                 for bound, count in zip(self.buckets, counts)]
+        lines.append(f'{self.name}_sum{_format_labels(pairs)} {_format_value(total)}')
+        lines.append(f'{self.name}_count{_format_labels(pairs)} {counts[-1]}')
+        return lines
+
+
+def exposition() -> str:
+    """Every Counter and Histogram in the Prometheus text format (version 0.0.4)."""
+    return '\n'.join(line for family in _families for line in family.lines()) + '\n'
+
+
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+WAIT_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+RUNS = Counter('fetch_runs_total', 'Pipeline runs by outcome.', ['status'])
+RUN_SECONDS = Histogram('fetch_run_duration_seconds', 'Wall time of pipeline runs.',
+                        ['status'], DURATION_BUCKETS)
+STAGE_SECONDS = Histogram('fetch_run_stage_seconds', 'Time a run spent in each timed stage.',
+                          ['stage'], DURATION_BUCKETS)
+EMAILS_DOWNLOADED = Counter('fetch_emails_downloaded_total', 'Emails downloaded from Gmail.')
+EMAILS_PARSED = Counter('fetch_emails_parsed_total', 'Emails parsed into transactions.')
+PARSE_ERRORS = Counter('fetch_parse_errors_total',
+                       'Failed parse attempts by bank format ("unknown" if none matched).',
+                       ['format'])
+TRANSACTIONS_ADDED = Counter('fetch_transactions_added_total', 'Transactions added to Dropbox.')
+DROPBOX_BYTES = Counter('fetch_dropbox_bytes_total', 'Bytes transferred to and from Dropbox.',
+                        ['direction'])
+RUN_LOCK_CONTENDED = Counter('fetch_run_lock_contended_total',
+                             'Times _run_lock was already held when a job wanted it.', ['job'])
+RUN_LOCK_WAIT = Histogram('fetch_run_lock_wait_seconds', 'Time jobs waited to acquire _run_lock.',
+                          ['job'], WAIT_BUCKETS)
+SCHEDULER_LAG = Histogram('fetch_scheduler_lag_seconds',
+                          'Delay between when the scheduler planned a job and when it started it.',
+                          ['job'], WAIT_BUCKETS)
+
+
+def _fold(metrics: RunMetrics, status: str, seconds: float) -> None:
+    """Add a finished run's figures to the process-wide totals."""
+    RUNS.inc(status=status)
+    RUN_SECONDS.observe(seconds, status=status)
+    for name, _ in TIMERS:
+        if name in metrics.values:
+            STAGE_SECONDS.observe(metrics.values[name], stage=name)
+    DROPBOX_BYTES.inc(metrics.values['dropbox_bytes_down'], direction='down')
+    DROPBOX_BYTES.inc(metrics.values['dropbox_bytes_up'], direction='up')
@@ -0,0 +1,255 @@
+"""
+Bank alert email formats, adapted from fetch-transactions/import.py.
+
+Each format is a BankFormat registered with register(); dispatch only reads the
+message headers, so adding a bank means adding a register(...) call below and
+nothing else. Edit patterns here to fix parsing, then call
+db.reset_stale_emails(conn, current_versions()) + pipeline.run() (the web UI's
+Re-parse button) to replay only the emails whose format changed.
+"""
+import binascii
+import email as email_lib
+import hashlib
+import re
+from email.parser import HeaderParser
+from typing import Optional
+
+# Bump when parsing code shared by every format (dates, body decoding, the
+# transaction fields) changes, to mark every parsed email stale. Pattern
+# edits are picked up by BankFormat.version without this.
+REVISION = 1
+
+_FLAGS = re.MULTILINE | re.DOTALL
+
+_LONG_DATE = re.compile(r'> ?(?P<mmm>\w+) (?P<dd>\d+), (?P<yyyy>\d+) ', _FLAGS)
+_SHORT_DATE = re.compile(r'Date: (?P<mm>\d\d)/(?P<dd>\d\d)/(?P<yy>\d\d)', _FLAGS)
+_MONTHS = {
+    'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04',
+    'May': '05', 'Jun': '06', 'Jul': '07', 'Aug': '08',
+    'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12',
+}
+
+_HEADER_END = re.compile(r'\r?\n\r?\n')
+_header_parser = HeaderParser()
+
+
+class ParseError(ValueError):
+    """An email that couldn't be parsed. `format` is the name of the BankFormat
+    that failed on it, or None if no format matched."""
+
+    def __init__(self, message: str, format: Optional[str] = None):
+        super().__init__(message)
+        self.format = format
+
+
+def _decode_body(payload: str) -> str:
+    """Undo quoted-printable encoding, mapping non-breaking spaces and CR-tab to spaces."""
+    body = binascii.a2b_qp(payload.encode('utf-8', errors='replace')).decode('utf-8', errors='replace')
+    return body.replace('\xa0', ' ').replace('\r\t', ' ')
+
+
+class BankFormat:
+    """One bank's alert email layout.
+
+    `description`, `amount` and `credit_amount` are regexes with a named group
+    of the same name (amount for both amounts); credit amounts are recorded as
+    negative. Either amount pattern may be None. Multipart formats are read
+    from the first MIME part. `version` changes whenever any of this does and
+    is stored with each email the format parses.
+    """
+
+    def __init__(self, name: str, source: str, description: str,
+                 amount: Optional[str] = None, credit_amount: Optional[str] = None,
+                 multipart: bool = False):
+        self.name = name
+        self.source = source
+        self.description = re.compile(description, _FLAGS)
+        self.amount = re.compile(amount, _FLAGS) if amount else None
+        self.credit_amount = re.compile(credit_amount, _FLAGS) if credit_amount else None
+        self.multipart = multipart
+        fingerprint = repr((REVISION, source, description, amount, credit_amount, multipart,
+                            _LONG_DATE.pattern, _SHORT_DATE.pattern))
+        self.version = f'{name}:{hashlib.sha1(fingerprint.encode()).hexdigest()[:12]}'
+
+    def __repr__(self) -> str:
+        return f'BankFormat({self.name!r})'
+
+    def to_transaction(self, gmail_id: str, payload: str, subject: Optional[str]) -> dict:
+        body = _decode_body(payload)
+
+        m = _LONG_DATE.search(body)
+        if m:
+            mm = _MONTHS[m.group('mmm')]
+            dd = m.group('dd').zfill(2)
+            yyyy = m.group('yyyy')
+        else:
+            m = _SHORT_DATE.search(body)
+            if not m:
+                raise ParseError(f'{self.name}: no date found', self.name)
+            mm, dd, yyyy = m.group('mm'), m.group('dd'), '20' + m.group('yy')
+
+        m = self.description.search(body)
+        if not m:
+            raise ParseError(f'{self.name}: no description found', self.name)
+        description = m.group('description')
+
+        m = self.amount.search(body) if self.amount else None
+        multiplier = 1
+        if not m and self.credit_amount:
+            m = self.credit_amount.search(body)
+            multiplier = -1
+        if not m:
+            raise ParseError(f'{self.name}: no amount found', self.name)
+        amount = int(float(m.group('amount').replace(',', '')) * 100.0 * multiplier)
+
+        return {
+            'id': gmail_id,
+            'description': description,
+            'original_line': subject or gmail_id,
+            'date': f'{yyyy}-{mm}-{dd}',
+            'tags': [],
+            'amount_cents': amount,
+            'transactions': [],
+            'source': self.source,
+            'notes': '',
+        }
+
+
+# ── Registry ──────────────────────────────────────────────────────────────────
+
+FORMATS = []       # every registered BankFormat, in registration order
+_by_domain = {}    # sender domain -> BankFormat
+_by_subject = {}   # subject phrase -> BankFormat
+_domain_re = None
+_subject_re = None
+
+
+def _alternation(keys, prefix: str = ''):
+    # Longest first, so a phrase that contains another one wins.
+    keys = sorted(keys, key=len, reverse=True)
+    return re.compile(prefix + '(' + '|'.join(map(re.escape, keys)) + ')') if keys else None
+
+
+def register(fmt: BankFormat, from_domain: Optional[str] = None,
+             subject: Optional[str] = None) -> BankFormat:
+    """Route emails sent from @from_domain, or whose subject contains `subject`, to fmt."""
+    global _domain_re, _subject_re
+    if not from_domain and not subject:
+        raise ValueError(f'{fmt.name}: register needs from_domain or subject')
+    FORMATS.append(fmt)
+    if from_domain:
+        _by_domain[from_domain] = fmt
+        _domain_re = _alternation(_by_domain, '@')
+    if subject:
+        _by_subject[subject] = fmt
+        _subject_re = _alternation(_by_subject)
+    return fmt
+
+
+def find_format(from_addr: str, subject: str) -> Optional[BankFormat]:
+    """Sender domain match first, then subject phrase; None if nothing matches."""
+    m = _domain_re.search(from_addr) if _domain_re else None
+    if m:
+        return _by_domain[m.group(1)]
+    m = _subject_re.search(subject) if _subject_re else None
+    if m:
+        return _by_subject[m.group(1)]
+    return None
+
+
+def _split(text: str):
+    """(headers, body) of an RFC 822 message, parsing only the header block."""
+    m = _HEADER_END.search(text)
+    if not m:
+        return _header_parser.parsestr(text), ''
+    return _header_parser.parsestr(text[:m.start()]), text[m.end():]
+
+
+def _first_part(headers, body: str):
+    """(headers, body) of the first MIME part, or None if it can't be found cheaply.
+
+    Equivalent to message_from_string(...).get_payload()[0] for well-formed
+    messages, without a full MIME parse of every part.
+    """
+    boundary = headers.get_boundary()
+    if not boundary:
+        return None
+    delimiter = '--' + boundary
+    start = body.find(delimiter)
+    end = body.find('\n' + delimiter, start + len(delimiter))
+    if start < 0 or end < 0:
+        return None
+    start = body.find('\n', start) + 1
+    part = body[start:end - 1 if body[end - 1:end] == '\r' else end]
+    return _split(part)
+
+
+def current_versions() -> list:
+    return [fmt.version for fmt in FORMATS]
+
+
+def parse(gmail_id: str, raw: bytes) -> dict:
+    """Parse an RFC 822 message (as stored by db.save_emails_many) into a transaction."""
+    return parse_versioned(gmail_id, raw)[0]
+
+
+def parse_versioned(gmail_id: str, raw: bytes) -> tuple:
+    """(transaction, version of the BankFormat that parsed it).
+
+    Dispatch reads only the header block; multipart formats then take the
+    first MIME part, falling back to a full parse for unusual layouts.
+    """
+    text = raw.decode('utf-8', errors='replace')
+    headers, body = _split(text)
+    from_addr = headers.get('From', '')
+    subject = headers.get('Subject', '')
+
+    fmt = find_format(from_addr, subject)
+    if fmt is None:
+        raise ParseError(f'Unknown email format: from={from_addr!r} subject={subject!r}')
+    if fmt.multipart:
+        part = _first_part(headers, body)
+        if part is None:
+            msg = email_lib.message_from_string(text).get_payload()[0]
+            part = msg, msg.get_payload()
+        headers, body = part
+    return fmt.to_transaction(gmail_id, body, headers.get('Subject')), fmt.version
+
+
+# ── Formats ───────────────────────────────────────────────────────────────────
+
+register(BankFormat(
+    'chase', 'email_chase',
+    description=r'>Merchant<[^<]+<td [^>]+>(?P<description>[^<]+)</td>',
+    amount=r'>Amount<[^<]+<td [^>]+>[$](?P<amount>[0-9.,]+)</td>',
+    credit_amount=r'>Credit Amount<[^<]+<td [^>]+>[$](?P<amount>[0-9.,]+)</td>',
+), from_domain='chase.com')
+
+register(BankFormat(
+    'jpmorgan', 'email_chase',
+    description=r'>Merchant: <[^<]+<td [^>]+> (?P<description>[^<]+)</td>',
+    amount=(r'>Authorized  (incremental )?amount:'
+            r'(<sup[^<]+<str[^<]+</strong></sup>)?'
+            r' <[^<]+<td [^>]+> [$](?P<amount>[0-9.,]+)  </td>'),
+), from_domain='jpmorgan.com')
+
+register(BankFormat(
+    'usaa_deposit', 'email_usaa',
+    description=r'From: (?P<description>[A-Za-z ]+)',
+    credit_amount=r'You received a deposit for [$](?P<amount>[0-9.,]+) to your',
+    multipart=True,
+), subject='USAA: Your Bank Account Received a Deposit')
+
+register(BankFormat(
+    'usaa_deposit2', 'email_usaa',
+    description=r'From: (?P<description>[A-Za-z ]+)',
+    credit_amount=r'You received a deposit of [$](?P<amount>[0-9.,]+) to your',
+    multipart=True,
+), subject='Deposit to Your Bank Account')
+
+register(BankFormat(
+    'usaa_debit', 'email_usaa',
+    description=r'To: (?P<description>[A-Za-z ]+)',
+    amount=r'[$](?P<amount>[0-9.,]+) came out of your account',
+    multipart=True,
+), subject='Debit Alert for Your USAA Bank Account')
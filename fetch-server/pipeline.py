@@ -2,29 +2,43 @@
 Fetch pipeline: Gmail → SQLite → Dropbox.
 
 Entry point: run(conn, config, log)
-  - Downloads unseen emails from Gmail into the emails table
+  - Downloads unseen emails from Gmail into the emails table, asking Gmail only
+    for history since the last run (full label list on first run or expiry)
   - Parses all pending/error emails into transactions
   - Merges new transactions into transactions.json on Dropbox
 
-Re-parse flow: call db.reset_parsed_emails(conn) before run() to re-parse
-all stored emails from scratch (useful after fixing a regex).
+Re-parse flow: call db.reset_stale_emails(conn, parsers.current_versions())
+before run() to re-parse the emails whose bank format changed since they were
+parsed (useful after fixing a regex), or db.reset_parsed_emails(conn) to
+re-parse everything from scratch.
 """
 import base64
 import email as email_lib
-import json
+import functools
+import multiprocessing
+import operator
 import os
-import re
+import posixpath
 import sqlite3
+import time
 import webbrowser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
 from typing import Callable, Optional
 
 import dropbox as dropbox_module
+from dropbox.exceptions import ApiError, AuthError
+from google.auth.exceptions import RefreshError
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 
 import db
+import metrics
+import parsers
+import txfile
 
 
 def _run_console_flow(flow):
@@ -48,7 +62,10 @@ SCOPES = [
     'https://www.googleapis.com/auth/gmail.send',
 ]
 
-Log = Callable[[str], None]
+# Called as log(line) or log(line, level='error').
+Log = Callable[..., None]
+# Called as on_event(run_id, event) for each RunLogger event (see RunLogger).
+OnEvent = Callable[[int, dict], None]
 
 
 # ── Gmail ──────────────────────────────────────────────────────────────────────
@@ -77,255 +94,752 @@ def gmail_service(token_file: str, credentials_file: str):
     return build('gmail', 'v1', credentials=creds)
 
 
-def _download_new_emails(conn, service, label_id: str, run_id: int, log: Log) -> int:
-    results = service.users().messages().list(
-        userId='me', labelIds=[label_id], maxResults=50
-    ).execute()
-    messages = results.get('messages', [])
-    downloaded = 0
-    for m in messages:
-        gmail_id = m['id']
-        if db.is_email_seen(conn, gmail_id):
-            continue
-        result = service.users().messages().get(
-            userId='me', id=gmail_id, format='raw'
-        ).execute()
-        raw = result['raw']
-        decoded = base64.urlsafe_b64decode(raw).decode('utf-8', errors='replace')
-        msg = email_lib.message_from_string(decoded)
-        db.save_email(
-            conn, gmail_id, raw,
-            subject=msg.get('Subject'),
-            from_addr=msg.get('From'),
-            fetch_run_id=run_id,
-        )
-        log(f'Downloaded: {msg.get("Subject", gmail_id)}')
-        downloaded += 1
+# Gmail history ID as of the last successful download; lets the next run ask
+# only for what changed instead of re-listing the label.
+HISTORY_ID_KEY = 'gmail_history_id'
+# Page token of the next label page an in-progress backfill will fetch.
+BACKFILL_PAGE_TOKEN_KEY = 'backfill_page_token'
+# Gmail rejects batch requests with more messages.get calls than this.
+GMAIL_MAX_BATCH = 100
+
+
+def _iter_label_pages(service, label_id: str, page_token: Optional[str] = None,
+                      page_size: int = 50):
+    """Yield (gmail_ids, next_page_token) for each page of the label, newest first.
+
+    Only one page is held at a time, however many messages the label has.
+    """
+    while True:
+        kwargs = {'pageToken': page_token} if page_token else {}
+        with metrics.timer('gmail_list'):
+            results = service.users().messages().list(
+                userId='me', labelIds=[label_id], maxResults=page_size, **kwargs
+            ).execute()
+        metrics.add('gmail_calls')
+        page_token = results.get('nextPageToken')
+        yield [m['id'] for m in results.get('messages', [])], page_token
+        if not page_token:
+            return
+
+
+def _list_label(service, label_id: str) -> list:
+    """Full listing: IDs of the newest 50 messages in the label."""
+    gmail_ids, _ = next(_iter_label_pages(service, label_id))
+    return gmail_ids
+
+
+def _list_history(service, label_id: str, start_history_id: str) -> tuple:
+    """Incremental listing: IDs of messages added to the label after start_history_id.
+
+    Returns (gmail_ids, latest_history_id). Raises HttpError 404 if
+    start_history_id is older than Gmail's history retention.
+    """
+    gmail_ids = []
+    page_token = None
+    while True:
+        kwargs = {'pageToken': page_token} if page_token else {}
+        with metrics.timer('gmail_list'):
+            results = service.users().history().list(
+                userId='me', startHistoryId=start_history_id, labelId=label_id,
+                historyTypes=['messageAdded', 'labelAdded'], **kwargs,
+            ).execute()
+        metrics.add('gmail_calls')
+        for record in results.get('history', []):
+            added = record.get('messagesAdded', []) + record.get('labelsAdded', [])
+            for a in added:
+                labels = a.get('labelIds') or a['message'].get('labelIds', [])
+                if label_id in labels and a['message']['id'] not in gmail_ids:
+                    gmail_ids.append(a['message']['id'])
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return gmail_ids, results['historyId']
+
+
+def _fetch_raw_messages(service, gmail_ids: list, log: Log) -> tuple:
+    """Fetch gmail_ids in a single batch round-trip.
+
+    Returns ([(gmail_id, raw)], failed). Messages Gmail fails to return are
+    logged and left out; `failed` counts those worth retrying on a later
+    run, i.e. all but the ones that 404 because they were deleted since
+    being listed.
+    """
+    raw_by_id = {}
+    failed = 0
+
+    def _collect(request_id, response, exception):
+        nonlocal failed
+        if isinstance(exception, HttpError) and exception.resp.status == 404:
+            log(f'Skipping {request_id}: no longer in Gmail')
+        elif exception is not None:
+            log(f'Download error {request_id}: {exception}', level='error')
+            failed += 1
+        else:
+            raw_by_id[request_id] = response['raw']
+            metrics.add('gmail_bytes', len(response['raw']))
+
+    batch = service.new_batch_http_request(callback=_collect)
+    for gmail_id in gmail_ids:
+        batch.add(service.users().messages().get(userId='me', id=gmail_id, format='raw'),
+                  request_id=gmail_id)
+    with metrics.timer('gmail_get'):
+        batch.execute()
+    metrics.add('gmail_calls')
+    return [(i, raw_by_id[i]) for i in gmail_ids if i in raw_by_id], failed
+
+
+def _download_messages(conn, service, gmail_ids: list, run_id: int, log: Log,
+                       batch_size: int = 50) -> tuple:
+    """Download gmail_ids (none of which are stored yet) into the emails table.
+
+    Messages are fetched batch_size (at most GMAIL_MAX_BATCH) per HTTP
+    round-trip and saved with one executemany per batch. Returns
+    (downloaded, failed) counts; see _fetch_raw_messages.
+    """
+    batch_size = min(batch_size, GMAIL_MAX_BATCH)
+    downloaded = failed = 0
+    for start in range(0, len(gmail_ids), batch_size):
+        rows = []
+        messages, batch_failed = _fetch_raw_messages(
+            service, gmail_ids[start:start + batch_size], log)
+        failed += batch_failed
+        for gmail_id, raw in messages:
+            raw = base64.urlsafe_b64decode(raw)
+            msg = email_lib.message_from_string(raw.decode('utf-8', errors='replace'))
+            rows.append((gmail_id, raw, msg.get('Subject'), msg.get('From')))
+            log(f'Downloaded: {msg.get("Subject", gmail_id)}')
+        with metrics.timer('sqlite_save'):
+            db.save_emails_many(conn, rows, run_id)
+        metrics.EMAILS_DOWNLOADED.inc(len(rows))
+        downloaded += len(rows)
+    return downloaded, failed
+
+
+def _download_new_emails(conn, service, label_id: str, run_id: int, log: Log,
+                         batch_size: int = 50) -> int:
+    # No db.transaction() around this stage: it would stay open across the
+    # Gmail calls, and a fatal error would roll back the log lines flushed
+    # meanwhile. Each batch of emails is committed as it is saved, and the
+    # history ID only after them, so an interrupted run just re-lists.
+    history_id = db.get_sync_state(conn, HISTORY_ID_KEY)
+    gmail_ids = None
+    if history_id:
+        try:
+            gmail_ids, latest_history_id = _list_history(service, label_id, history_id)
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            log(f'Gmail history {history_id} has expired; falling back to a full list')
+    if gmail_ids is None:
+        # Read the history ID before listing so mail that arrives mid-list is
+        # picked up by the next incremental sync rather than skipped.
+        with metrics.timer('gmail_list'):
+            latest_history_id = service.users().getProfile(userId='me').execute()['historyId']
+        metrics.add('gmail_calls')
+        gmail_ids = _list_label(service, label_id)
+
+    seen = db.seen_email_ids(conn, gmail_ids)
+    new_ids = [i for i in gmail_ids if i not in seen]
+    downloaded, failed = _download_messages(conn, service, new_ids, run_id, log, batch_size)
+
+    if failed:
+        # Don't move past messages that failed, so the next run retries them.
+        log('Keeping previous Gmail history ID until failed downloads succeed')
+    elif latest_history_id != history_id:
+        db.set_sync_state(conn, HISTORY_ID_KEY, latest_history_id)
     return downloaded
 
 
-# ── Email parsing ──────────────────────────────────────────────────────────────
-# Adapted from fetch-transactions/import.py. Edit patterns here to fix parsing;
-# then call db.reset_parsed_emails() + run() to replay against stored emails.
-
-CHASE_PATTERNS = {
-    'source': 'email_chase',
-    'description': r'>Merchant<[^<]+<td [^>]+>(?P<description>[^<]+)</td>',
-    'amount': r'>Amount<[^<]+<td [^>]+>[$](?P<amount>[0-9.,]+)</td>',
-    'credit amount': r'>Credit Amount<[^<]+<td [^>]+>[$](?P<amount>[0-9.,]+)</td>',
-}
-
-JPMORGAN_PATTERNS = {
-    'source': 'email_chase',
-    'description': r'>Merchant: <[^<]+<td [^>]+> (?P<description>[^<]+)</td>',
-    'amount': (r'>Authorized  (incremental )?amount:'
-               r'(<sup[^<]+<str[^<]+</strong></sup>)?'
-               r' <[^<]+<td [^>]+> [$](?P<amount>[0-9.,]+)  </td>'),
-}
-
-USAA_DEPOSIT_PATTERNS = {
-    'source': 'email_usaa',
-    'description': r'From: (?P<description>[A-Za-z ]+)',
-    'amount': r'NOTHING_NOT_IN_EMAIL',
-    'credit amount': r'You received a deposit for [$](?P<amount>[0-9.,]+) to your',
-}
-
-USAA2_DEPOSIT_PATTERNS = {
-    'source': 'email_usaa',
-    'description': r'From: (?P<description>[A-Za-z ]+)',
-    'amount': r'NOTHING_NOT_IN_EMAIL',
-    'credit amount': r'You received a deposit of [$](?P<amount>[0-9.,]+) to your',
-}
-
-USAA_DEBIT_PATTERNS = {
-    'source': 'email_usaa',
-    'description': r'To: (?P<description>[A-Za-z ]+)',
-    'amount': r'[$](?P<amount>[0-9.,]+) came out of your account',
-}
-
-
-def _email_to_transaction(gmail_id: str, msg, patterns: dict) -> dict:
-    body = (msg.get_payload()
-        .replace('=\r\n', '')
-        .replace('=3D', '=')
-        .replace('=C2=A0', ' ')
-        .replace('=0D=09', ' ')
-    )
-
-    m = re.search(r'> ?(?P<mmm>\w+) (?P<dd>\d+), (?P<yyyy>\d+) ', body, re.MULTILINE | re.DOTALL)
-    if m:
-        mm = {
-            'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04',
-            'May': '05', 'Jun': '06', 'Jul': '07', 'Aug': '08',
-            'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12',
-        }[m.group('mmm')]
-        dd = m.group('dd').zfill(2)
-        yyyy = m.group('yyyy')
-    else:
-        m = re.search(r'Date: (?P<mm>\d\d)/(?P<dd>\d\d)/(?P<yy>\d\d)', body, re.MULTILINE | re.DOTALL)
-        mm, dd, yyyy = m.group('mm'), m.group('dd'), '20' + m.group('yy')
-    date = f'{yyyy}-{mm}-{dd}'
-
-    m = re.search(patterns['description'], body, re.MULTILINE | re.DOTALL)
-    description = m.group('description')
-
-    m = re.search(patterns['amount'], body, re.MULTILINE | re.DOTALL)
-    multiplier = 1
-    if not m:
-        m = re.search(patterns['credit amount'], body, re.MULTILINE | re.DOTALL)
-        multiplier = -1
-    amount = int(float(m.group('amount').replace(',', '')) * 100.0 * multiplier)
-
-    return {
-        'id': gmail_id,
-        'description': description,
-        'original_line': msg.get('Subject') or gmail_id,
-        'date': date,
-        'tags': [],
-        'amount_cents': amount,
-        'transactions': [],
-        'source': patterns['source'],
-        'notes': '',
-    }
-
-
-def _parse_email(gmail_id: str, raw_content: str) -> dict:
-    decoded = base64.urlsafe_b64decode(raw_content).decode('utf-8', errors='replace')
-    msg = email_lib.message_from_string(decoded)
-    from_addr = msg.get('From', '')
-    subject = msg.get('Subject', '')
-
-    if '@chase.com' in from_addr:
-        return _email_to_transaction(gmail_id, msg, CHASE_PATTERNS)
-    elif '@jpmorgan.com' in from_addr:
-        return _email_to_transaction(gmail_id, msg, JPMORGAN_PATTERNS)
-    elif 'USAA: Your Bank Account Received a Deposit' in subject:
-        return _email_to_transaction(gmail_id, msg.get_payload()[0], USAA_DEPOSIT_PATTERNS)
-    elif 'Deposit to Your Bank Account' in subject:
-        return _email_to_transaction(gmail_id, msg.get_payload()[0], USAA2_DEPOSIT_PATTERNS)
-    elif 'Debit Alert for Your USAA Bank Account' in subject:
-        return _email_to_transaction(gmail_id, msg.get_payload()[0], USAA_DEBIT_PATTERNS)
+def _backfill_emails(conn, service, label_id: str, run_id: int, log: Log,
+                     batch_size: int = 50, page_size: int = 500) -> int:
+    """Walk every page of the label, downloading anything missing.
+
+    Stops at the first page that is entirely stored already. The token of
+    the next page is stored once each page's emails are committed, so an
+    interrupted backfill resumes from the page it was on. After a message
+    fails to download the token stays put, so the next backfill resumes
+    from that message's page and retries it.
+    """
+    page_token = db.get_sync_state(conn, BACKFILL_PAGE_TOKEN_KEY)
+    if page_token:
+        log('Resuming interrupted backfill')
+    downloaded = failed = 0
+    pages = 0
+    for gmail_ids, next_page_token in _iter_label_pages(service, label_id, page_token, page_size):
+        pages += 1
+        seen = db.seen_email_ids(conn, gmail_ids)
+        if gmail_ids and len(seen) == len(gmail_ids):
+            log(f'Page {pages} already downloaded; stopping backfill')
+            break
+        new_ids = [i for i in gmail_ids if i not in seen]
+        page_downloaded, page_failed = _download_messages(
+            conn, service, new_ids, run_id, log, batch_size)
+        downloaded += page_downloaded
+        failed += page_failed
+        if next_page_token and not failed:
+            db.set_sync_state(conn, BACKFILL_PAGE_TOKEN_KEY, next_page_token)
+    if failed:
+        log(f'{failed} message(s) failed to download; the next backfill resumes '
+            'from the page the first one is on', level='error')
     else:
-        raise ValueError(f'Unknown email format: from={from_addr!r} subject={subject!r}')
+        db.delete_sync_state(conn, BACKFILL_PAGE_TOKEN_KEY)
+    log(f'Backfill checked {pages} page(s)')
+    return downloaded
 
 
-def _parse_pending_emails(conn, log: Log) -> list:
-    pending = db.get_emails_pending_parse(conn)
-    transactions = []
-    for row in pending:
-        gmail_id = row['gmail_id']
-        try:
-            t = _parse_email(gmail_id, row['raw_content'])
-            db.mark_email_parsed(conn, gmail_id)
-            transactions.append(t)
-            log(f'Parsed: {t["description"]}  {t["date"]}')
-        except Exception as e:
-            db.mark_email_error(conn, gmail_id, str(e))
-            log(f'Parse error {gmail_id}: {e}')
-    log(f'Parsed {len(transactions)}/{len(pending)} pending email(s)')
-    return transactions
+# ── Email parsing ──────────────────────────────────────────────────────────────
+# Bank formats live in parsers.py.
+
+def _parse_email(gmail_id: str, raw: bytes) -> dict:
+    """Parse an RFC 822 message (as stored by db.save_emails_many) into a transaction."""
+    return parsers.parse(gmail_id, raw)
+
+
+def _parse_job(job: tuple) -> tuple:
+    """(gmail_id, compressed raw) -> (gmail_id, transaction, parser version,
+    error, name of the format that failed or None).
+
+    Module-level so it can run in a ProcessPoolExecutor worker.
+    """
+    gmail_id, blob = job
+    try:
+        t, version = parsers.parse_versioned(gmail_id, db.unpack_raw(blob))
+        return gmail_id, t, version, None, None
+    except Exception as e:
+        return gmail_id, None, None, str(e), getattr(e, 'format', None)
+
+
+def _iter_parsed_transactions(conn, log: Log, chunk_size: int = 500, executor=None):
+    """Parse pending/error emails chunk_size at a time, yielding each transaction.
+
+    Only one chunk of (compressed) emails is in memory at once, and each
+    chunk's parse statuses and transactions table rows are committed
+    together before its transactions are yielded, so peak memory is bounded
+    by chunk_size however large the archive being re-parsed is. With an
+    executor, each chunk is parsed by its workers; results come back in
+    order and are written from here.
+    """
+    # Send workers 25 emails per round-trip rather than one at a time.
+    parse_all = functools.partial(executor.map, chunksize=25) if executor else map
+    parsed = total = 0
+    for chunk in db.iter_emails_pending_parse(conn, chunk_size):
+        transactions = []
+        versions = []
+        errors = []
+        jobs = [(row['gmail_id'], row['raw']) for row in chunk]
+        with metrics.timer('parse'):
+            results = list(parse_all(_parse_job, jobs))
+        for gmail_id, t, version, error, failed_format in results:
+            if error is None:
+                transactions.append(t)
+                versions.append((gmail_id, version))
+                log(f'Parsed: {t["description"]}  {t["date"]}')
+            else:
+                errors.append((gmail_id, error))
+                metrics.PARSE_ERRORS.inc(format=failed_format or 'unknown')
+                log(f'Parse error {gmail_id}: {error}', level='error')
+        with metrics.timer('sqlite_save'), db.transaction(conn):
+            db.mark_parsed_many(conn, versions)
+            db.save_transactions_many(conn, transactions)
+            db.mark_errors_many(conn, errors)
+            db.delete_transactions(conn, [gmail_id for gmail_id, _ in errors])
+        metrics.EMAILS_PARSED.inc(len(transactions))
+        parsed += len(transactions)
+        total += len(chunk)
+        yield from transactions
+    log(f'Parsed {parsed}/{total} pending email(s)')
+
+
+# Below this many pending emails, starting worker processes costs more than
+# parsing serially.
+PARALLEL_PARSE_MIN = 200
+
+
+def _parse_pending_emails(conn, log: Log, workers: int = 1) -> list:
+    # Only the (small) transaction dicts are collected for the Dropbox stage;
+    # email bodies are streamed by _iter_parsed_transactions.
+    if workers <= 1 or db.count_emails_pending_parse(conn) < PARALLEL_PARSE_MIN:
+        return list(_iter_parsed_transactions(conn, log))
+    log(f'Parsing with {workers} worker processes')
+    # spawn rather than fork: the server process has scheduler and request threads.
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        return list(_iter_parsed_transactions(conn, log, executor=executor))
 
 
 # ── Dropbox ───────────────────────────────────────────────────────────────────
 
-def _collect_ids(transactions) -> set:
+def _index(transactions: list) -> tuple:
+    """(IDs of every transaction including nested splits, whether the top level
+    is sorted newest first).
+
+    One pass with an explicit stack, so deep split trees cost no recursion.
+    """
     seen = set()
+    is_sorted = True
+    previous = None
+    nested = []
     for t in transactions:
         seen.add(t['id'])
-        seen |= _collect_ids(t.get('transactions', []))
-    return seen
+        date = t['date']
+        if previous is not None and date > previous:
+            is_sorted = False
+        previous = date
+        if t.get('transactions'):
+            nested.append(t['transactions'])
+    while nested:
+        for t in nested.pop():
+            seen.add(t['id'])
+            if t.get('transactions'):
+                nested.append(t['transactions'])
+    return seen, is_sorted
+
+
+def _insert_by_date(transactions: list, t: dict) -> None:
+    """Insert t into a newest-first list after every transaction on or after its
+    date, where a stable sort of the list with t appended would put it."""
+    date = t['date']
+    lo, hi = 0, len(transactions)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if transactions[mid]['date'] < date:
+            hi = mid
+        else:
+            lo = mid + 1
+    transactions.insert(lo, t)
 
 
-def _merge(existing: list, new_transactions: list, log: Log) -> list:
-    seen_ids = _collect_ids(existing)
+# Past this many additions one sort beats inserting each into the list.
+MERGE_INSERT_MAX = 32
+
+
+def _unseen(new_transactions: list, seen_ids: set, log: Log) -> list:
+    """new_transactions whose IDs aren't in seen_ids (which is updated), logged."""
     added = []
     for t in new_transactions:
         if t['id'] in seen_ids:
             continue
-        existing.append(t)
         seen_ids.add(t['id'])
         added.append(t)
         log(f'  + {t["description"]}  {t["date"]}')
-    existing.sort(key=lambda t: t['date'], reverse=True)
     return added
 
 
-def sync_to_dropbox(new_transactions: list, access_token: str, dropbox_path: str, log: Log) -> list:
-    """Merge new_transactions into transactions.json on Dropbox. Returns list of added transactions."""
-    dbx = dropbox_module.Dropbox(access_token)
-    _, response = dbx.files_download(dropbox_path)
-    existing = json.loads(response.content.decode('utf-8'))
-    added = _merge(existing, new_transactions, log)
-    if added:
-        dbx.files_upload(
-            json.dumps(existing).encode('utf-8'),
-            dropbox_path,
-            dropbox_module.files.WriteMode.overwrite,
-        )
-        log(f'Uploaded {len(added)} new transaction(s) to Dropbox')
+def _merge(existing: list, new_transactions: list, log: Log) -> list:
+    seen_ids, is_sorted = _index(existing)
+    added = _unseen(new_transactions, seen_ids, log)
+    if is_sorted and len(added) <= MERGE_INSERT_MAX:
+        for t in added:
+            _insert_by_date(existing, t)
     else:
-        log('No new transactions to upload')
+        existing.extend(added)
+        existing.sort(key=operator.itemgetter('date'), reverse=True)
     return added
 
 
+class DropboxCache:
+    """Local copy of transactions.json as of the last sync.
+
+    The file's bytes live at `path`; the rev and content_hash Dropbox
+    reported for them are kept in sync_state. A copy is only trusted while
+    both still match what files_get_metadata returns.
+    """
+    REV_KEY = 'dropbox_rev'
+    CONTENT_HASH_KEY = 'dropbox_content_hash'
+
+    def __init__(self, conn: sqlite3.Connection, path: str):
+        self.conn = conn
+        self.path = path
+
+    def get(self, metadata) -> Optional[bytes]:
+        if (db.get_sync_state(self.conn, self.REV_KEY) != metadata.rev
+                or db.get_sync_state(self.conn, self.CONTENT_HASH_KEY) != metadata.content_hash):
+            return None
+        try:
+            with open(self.path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, metadata, data: bytes) -> None:
+        # File first: after a crash in between, the stored rev is an older one
+        # Dropbox never reports again, so the copy is simply re-downloaded.
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+        with db.transaction(self.conn):
+            db.set_sync_state(self.conn, self.REV_KEY, metadata.rev)
+            db.set_sync_state(self.conn, self.CONTENT_HASH_KEY, metadata.content_hash)
+
+
+def _download_transactions(dbx, dropbox_path: str, cache: Optional[DropboxCache], log: Log) -> tuple:
+    """(transactions, FileMetadata of the revision they came from)."""
+    data = None
+    if cache is not None:
+        metrics.add('dropbox_calls')
+        with metrics.timer('dropbox_download'):
+            metadata = dbx.files_get_metadata(dropbox_path)
+            data = cache.get(metadata)
+        if data is not None:
+            log('transactions.json unchanged since last sync; using local copy')
+    if data is None:
+        metrics.add('dropbox_calls')
+        with metrics.timer('dropbox_download'):
+            metadata, response = dbx.files_download(dropbox_path)
+            data = response.content
+        metrics.add('dropbox_bytes_down', len(data))
+        if cache is not None:
+            cache.put(metadata, data)
+    with metrics.timer('merge'):
+        return txfile.load(data), metadata
+
+
+def _upload(dbx, data: bytes, path: str, mode):
+    metrics.add('dropbox_calls')
+    metrics.add('dropbox_bytes_up', len(data))
+    with metrics.timer('dropbox_upload'):
+        return dbx.files_upload(data, path, mode)
+
+
+def _is_conflict(e: ApiError) -> bool:
+    return (isinstance(e.error, dropbox_module.files.UploadError) and e.error.is_path()
+            and e.error.get_path().reason.is_conflict())
+
+
+# Attempts at uploading before giving up on a run, and the delay before the
+# first retry (doubled after each further conflict).
+UPLOAD_ATTEMPTS = 4
+UPLOAD_BACKOFF_SECONDS = 0.5
+
+
+def _backoff_or_raise(e: ApiError, attempt: int, name: str, log: Log) -> None:
+    """Wait before retrying an upload that hit a conflict; re-raise anything else."""
+    if not _is_conflict(e) or attempt == UPLOAD_ATTEMPTS - 1:
+        raise e
+    delay = UPLOAD_BACKOFF_SECONDS * 2 ** attempt
+    log(f'{name} changed during sync; retrying in {delay:g}s')
+    time.sleep(delay)
+
+
+def sync_to_dropbox(new_transactions: list, dbx, dropbox_path: str, log: Log,
+                    cache: Optional[DropboxCache] = None) -> list:
+    """Merge new_transactions into transactions.json on Dropbox. Returns list of added transactions.
+
+    With a cache, the file is only downloaded when Dropbox has a different
+    revision from the one last seen. The upload only succeeds if the file is
+    still at the revision it was merged into; if another client saved in the
+    meantime, the new revision is downloaded and just the transactions this
+    call was adding are merged into it again.
+    """
+    pending = new_transactions
+    for attempt in range(UPLOAD_ATTEMPTS):
+        existing, metadata = _download_transactions(dbx, dropbox_path, cache, log)
+        with metrics.timer('merge'):
+            added = _merge(existing, pending, log)
+            data = txfile.dump(existing) if added else None
+        if not added:
+            log('No new transactions to upload')
+            return []
+        try:
+            uploaded = _upload(dbx, data, dropbox_path,
+                               dropbox_module.files.WriteMode.update(metadata.rev))
+        except ApiError as e:
+            _backoff_or_raise(e, attempt, 'transactions.json', log)
+            pending = added
+            continue
+        if cache is not None:
+            cache.put(uploaded, data)
+        log(f'Uploaded {len(added)} new transaction(s) to Dropbox')
+        return added
+
+
+# ── Dropbox delta journal ─────────────────────────────────────────────────────
+# Optional (config dropbox_delta_mode): instead of rewriting transactions.json,
+# runs append new transactions to a small JSON Lines journal next to it, and
+# compact_dropbox() folds the journal into transactions.json on a schedule or
+# once the journal outgrows dropbox_compact_bytes. The tracker frontend only
+# reads transactions.json, so journal entries show up there after compaction.
+
+def delta_path(dropbox_path: str) -> str:
+    """transactions.json -> transactions.delta.jsonl in the same folder."""
+    return posixpath.splitext(dropbox_path)[0] + '.delta.jsonl'
+
+
+def _is_not_found(e: ApiError) -> bool:
+    return (isinstance(e.error, dropbox_module.files.DownloadError) and e.error.is_path()
+            and e.error.get_path().is_not_found())
+
+
+def _download_delta(dbx, path: str) -> tuple:
+    """(raw journal bytes, its rev); (b'', None) if there is no journal yet."""
+    metrics.add('dropbox_calls')
+    try:
+        with metrics.timer('dropbox_download'):
+            metadata, response = dbx.files_download(path)
+    except ApiError as e:
+        if not _is_not_found(e):
+            raise
+        return b'', None
+    metrics.add('dropbox_bytes_down', len(response.content))
+    return response.content, metadata.rev
+
+
+def append_to_delta(new_transactions: list, dbx, dropbox_path: str, log: Log,
+                    cache: Optional[DropboxCache] = None, compact_bytes: int = 0) -> list:
+    """Append the new_transactions not yet in transactions.json or the journal
+    to the journal. Returns the ones appended.
+
+    transactions.json is only read (through the cache, so normally only its
+    metadata is fetched). Once the journal reaches compact_bytes (if set) it is
+    compacted straight away.
+    """
+    path = delta_path(dropbox_path)
+    existing, _ = _download_transactions(dbx, dropbox_path, cache, log)
+    main_ids = _index(existing)[0]
+    del existing
+    pending = new_transactions
+    for attempt in range(UPLOAD_ATTEMPTS):
+        data, rev = _download_delta(dbx, path)
+        with metrics.timer('merge'):
+            seen_ids = main_ids | {t['id'] for t in txfile.load_lines(data)}
+            added = _unseen(pending, seen_ids, log)
+            data += txfile.dump_lines(added)
+        if not added:
+            log('No new transactions to append')
+            return []
+        mode = (dropbox_module.files.WriteMode.update(rev) if rev
+                else dropbox_module.files.WriteMode.add)
+        try:
+            _upload(dbx, data, path, mode)
+        except ApiError as e:
+            _backoff_or_raise(e, attempt, 'Delta journal', log)
+            pending = added
+            continue
+        log(f'Appended {len(added)} new transaction(s) to the delta journal')
+        if compact_bytes and len(data) >= compact_bytes:
+            compact_dropbox(dbx, dropbox_path, log, cache)
+        return added
+
+
+def compact_dropbox(dbx, dropbox_path: str, log: Log,
+                    cache: Optional[DropboxCache] = None) -> int:
+    """Fold the delta journal into transactions.json and empty it.
+
+    Returns the number of journal entries folded in. Entries appended while
+    this runs are left in the journal for next time.
+    """
+    path = delta_path(dropbox_path)
+    data, rev = _download_delta(dbx, path)
+    journal = txfile.load_lines(data)
+    if not journal:
+        return 0
+    log(f'Compacting {len(journal)} journal entr{"y" if len(journal) == 1 else "ies"}')
+    sync_to_dropbox(journal, dbx, dropbox_path, log, cache)
+    try:
+        _upload(dbx, b'', path, dropbox_module.files.WriteMode.update(rev))
+    except ApiError as e:
+        if not _is_conflict(e):
+            raise
+        # Folded entries left behind are skipped by ID at the next compaction.
+        log('Delta journal changed during compaction; emptying it next time')
+    return len(journal)
+
+
+# ── Clients ───────────────────────────────────────────────────────────────────
+
+class Clients:
+    """Gmail service and Dropbox client, built on first use and kept across runs.
+
+    Reading token.json, building the Gmail discovery client and opening new
+    HTTPS connections to both APIs costs more than a run that finds nothing
+    new; kept clients reuse their connections. The Gmail credentials refresh
+    themselves whenever the access token has expired. After an auth error,
+    forget() drops the client it came from so the next use rebuilds it.
+
+    Neither client is thread-safe (the Gmail service sits on httplib2), so
+    one Clients must not be used by two threads at once.
+    """
+
+    def __init__(self, config: dict):
+        self._config = config
+        self._gmail = None
+        self._dropbox = None
+
+    def gmail(self):
+        if self._gmail is None:
+            self._gmail = gmail_service(self._config['gmail_token_file'],
+                                        self._config['gmail_credentials_file'])
+        return self._gmail
+
+    def dropbox(self):
+        if self._dropbox is None:
+            self._dropbox = dropbox_module.Dropbox(self._config['dropbox_access_token'])
+        return self._dropbox
+
+    def forget(self, error: Exception) -> bool:
+        """Drop the client an auth error came from. False if error isn't one."""
+        if isinstance(error, RefreshError) or (isinstance(error, HttpError) and error.resp.status == 401):
+            self._gmail = None
+        elif isinstance(error, AuthError):
+            self._dropbox = None
+        else:
+            return False
+        return True
+
+
 # ── Entry point ───────────────────────────────────────────────────────────────
 
-def run(conn: sqlite3.Connection, config: dict, log: Log) -> dict:
+class RunLogger:
+    """Log callback for one run: echoes each line and records it in run_log.
+
+    Lines are buffered and written FLUSH_LINES at a time, plus on every stage
+    change and on flush(), rather than one INSERT + commit per line.
+
+    on_event, if given, is also called straight away with each event as a
+    dict: {'type': 'line', 'n', 'logged_at', 'level', 'stage', 'line'} (n
+    counts from 0 in run_log order), {'type': 'stage', 'stage'} and, from
+    end(), {'type': 'end', 'status'}.
+    """
+    FLUSH_LINES = 100
+
+    def __init__(self, conn: sqlite3.Connection, run_id: int, echo: Log,
+                 on_event: Optional[OnEvent] = None):
+        self._conn = conn
+        self._run_id = run_id
+        self._echo = echo
+        self._on_event = on_event
+        self._buffer = []
+        self._lines = 0
+        self.stage = None
+
+    def __call__(self, line: str, level: str = 'info') -> None:
+        self._echo(line)
+        logged_at = datetime.now(timezone.utc).isoformat()
+        self._buffer.append((logged_at, level, self.stage, line))
+        if self._on_event:
+            self._on_event(self._run_id, {'type': 'line', 'n': self._lines, 'logged_at': logged_at,
+                                          'level': level, 'stage': self.stage, 'line': line})
+        self._lines += 1
+        if len(self._buffer) >= self.FLUSH_LINES:
+            self.flush()
+
+    def set_stage(self, stage: str) -> None:
+        self.flush()
+        self.stage = stage
+        if self._on_event:
+            self._on_event(self._run_id, {'type': 'stage', 'stage': stage})
+
+    def end(self, status: str) -> None:
+        """Announce that the run has finished (after fetch_runs says so)."""
+        if self._on_event:
+            self._on_event(self._run_id, {'type': 'end', 'status': status})
+
+    def flush(self) -> None:
+        if self._buffer:
+            db.append_log_many(self._conn, self._run_id, self._buffer)
+            self._buffer = []
+
+
+def run(conn: sqlite3.Connection, config: dict, log: Log, backfill: bool = False,
+        clients: Optional[Clients] = None, on_event: Optional[OnEvent] = None) -> dict:
     """
     Run the full fetch pipeline. config keys:
       dropbox_access_token, dropbox_path, gmail_label_id,
-      gmail_token_file, gmail_credentials_file
+      gmail_token_file, gmail_credentials_file, gmail_batch_size, parse_workers
+
+    With backfill=True every page of the Gmail label is walked (see
+    _backfill_emails) instead of only what changed since the last run.
+    Pass the same clients to every run to reuse their connections; without
+    them, new ones are built for this run. Stage timings and call counts
+    are saved to run_metrics (see metrics.py). on_event receives the run's
+    log lines and stage changes as they happen (see RunLogger).
     """
+    clients = clients or Clients(config)
     run_id = db.start_run(conn)
+    _log = RunLogger(conn, run_id, log, on_event)
 
-    def _log(line: str) -> None:
-        log(line)
-        db.append_log(conn, run_id, line)
-
-    try:
-        service = gmail_service(config['gmail_token_file'], config['gmail_credentials_file'])
-        downloaded = _download_new_emails(conn, service, config['gmail_label_id'], run_id, _log)
-        _log(f'Downloaded {downloaded} new email(s) from Gmail')
-
-        new_transactions = _parse_pending_emails(conn, _log)
-
-        # Re-include recently added transactions so any lost due to a stale
-        # frontend save are restored on the next run. _merge deduplicates by
-        # ID, so transactions already in Dropbox are silently skipped.
-        recently_added = db.get_recently_added_transactions(conn)
-        added = sync_to_dropbox(
-            recently_added + new_transactions,
-            config['dropbox_access_token'],
-            config['dropbox_path'],
-            _log,
-        )
-
-        db.finish_run(conn, run_id, 'success',
-                      emails_downloaded=downloaded,
-                      emails_parsed=len(new_transactions),
-                      transactions_added=len(added),
-                      added_transactions=added)
-        return {'run_id': run_id, 'status': 'success',
-                'downloaded': downloaded, 'parsed': len(new_transactions), 'added': len(added)}
+    with metrics.recording(conn) as run_metrics:
+        try:
+            _log.set_stage('gmail')
+            service = clients.gmail()
+            download = _backfill_emails if backfill else _download_new_emails
+            downloaded = download(conn, service, config['gmail_label_id'], run_id, _log,
+                                  batch_size=config['gmail_batch_size'])
+            _log(f'Downloaded {downloaded} new email(s) from Gmail')
+
+            _log.set_stage('parse')
+            new_transactions = _parse_pending_emails(conn, _log, config['parse_workers'])
+
+            _log.set_stage('dropbox')
+            # Re-include recently added transactions so any lost due to a stale
+            # frontend save are restored on the next run. _merge deduplicates by
+            # ID, so transactions already in Dropbox are silently skipped. Our
+            # uploads can't clobber a frontend save (update mode), but the
+            # frontend still saves in overwrite mode and can clobber ours.
+            candidates = db.get_recently_added_transactions(conn, config['replay_days']) + new_transactions
+            if candidates and config['dropbox_delta_mode']:
+                added = append_to_delta(
+                    candidates,
+                    clients.dropbox(),
+                    config['dropbox_path'],
+                    _log,
+                    DropboxCache(conn, config['dropbox_cache_file']),
+                    compact_bytes=config['dropbox_compact_bytes'],
+                )
+                db.mark_transactions_added(conn, [t['id'] for t in added])
+            elif candidates:
+                added = sync_to_dropbox(
+                    candidates,
+                    clients.dropbox(),
+                    config['dropbox_path'],
+                    _log,
+                    DropboxCache(conn, config['dropbox_cache_file']),
+                )
+                db.mark_transactions_added(conn, [t['id'] for t in added])
+            else:
+                added = []
+                _log('Nothing to sync; skipping Dropbox')
+            metrics.TRANSACTIONS_ADDED.inc(len(added))
+
+            _log.flush()
+            db.save_run_metrics(conn, run_id, dict(run_metrics.values))
+            db.finish_run(conn, run_id, 'success',
+                          emails_downloaded=downloaded,
+                          emails_parsed=len(new_transactions),
+                          transactions_added=len(added))
+            _log.end('success')
+            return {'run_id': run_id, 'status': 'success',
+                    'downloaded': downloaded, 'parsed': len(new_transactions), 'added': len(added)}
 
-    except Exception as e:
-        _log(f'Fatal error: {e}')
-        db.finish_run(conn, run_id, 'error')
-        raise
+        except Exception as e:
+            _log(f'Fatal error: {e}', level='error')
+            if clients.forget(e):
+                _log('Authentication failed; the API client will be rebuilt on the next run',
+                     level='error')
+            _log.flush()
+            db.save_run_metrics(conn, run_id, dict(run_metrics.values))
+            db.finish_run(conn, run_id, 'error')
+            _log.end('error')
+            raise
 
 
 # ── One-time Gmail auth setup ─────────────────────────────────────────────────
 
-def send_email(config: dict, to: str, subject: str, body: str) -> None:
+def send_email(config: dict, to: str, subject: str, body: str,
+               clients: Optional[Clients] = None) -> None:
     """Send an email via the Gmail API using the existing OAuth credentials."""
-    import base64
     from email.mime.text import MIMEText
-    service = gmail_service(config['gmail_token_file'], config['gmail_credentials_file'])
+    clients = clients or Clients(config)
+    service = clients.gmail()
     msg = MIMEText(body)
     msg['To'] = to
     msg['Subject'] = subject
     raw = base64.urlsafe_b64encode(msg.as_bytes()).decode()
-    service.users().messages().send(userId='me', body={'raw': raw}).execute()
+    try:
+        service.users().messages().send(userId='me', body={'raw': raw}).execute()
+    except Exception as e:
+        clients.forget(e)
+        raise
 
 
 if __name__ == '__main__':
@@ -335,3 +849,7 @@ if __name__ == '__main__':
         c = cfg.load()
         gmail_service(c['gmail_token_file'], c['gmail_credentials_file'])
         print('Gmail auth setup complete.')
+    elif '--backfill' in sys.argv:
+        c = cfg.load()
+        db.init_db(c['db_path'])
+        run(db.get_conn(c['db_path']), c, print, backfill=True)
@@ -0,0 +1,39 @@
+"""Per-thread SQLite connections for the server process."""
+import sqlite3
+import threading
+import weakref
+
+import db
+
+
+class ConnectionPool:
+    """Hands out one connection per thread, opened on first use.
+
+    The scheduler thread, the threads started by /fetch and /reparse, and the
+    request handlers each get their own connection, so a pipeline transaction
+    is never shared with a dashboard read. A thread's connection is closed
+    when the thread exits and its thread-local is released.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._conns = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def get(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = db.get_conn(self.db_path)
+            self._local.conn = conn
+            with self._lock:
+                self._conns.add(conn)
+        return conn
+
+    def close_all(self) -> None:
+        with self._lock:
+            conns = list(self._conns)
+            self._conns.clear()
+        for conn in conns:
+            conn.close()
+        self._local = threading.local()
@@ -1,18 +1,28 @@
+import asyncio
 import json
 import os
 import subprocess
 import threading
-from contextlib import asynccontextmanager
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, timedelta, timezone
+from typing import Optional
 
+from apscheduler.events import EVENT_JOB_SUBMITTED
 from apscheduler.schedulers.background import BackgroundScheduler
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import (HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse,
+                               StreamingResponse)
 from fastapi.templating import Jinja2Templates
 
 import config as cfg
 import db
+import metrics
+import parsers
 import pipeline
+from live import LiveLog
+from pool import ConnectionPool
 
 # ── State ─────────────────────────────────────────────────────────────────────
 
@@ -21,14 +31,24 @@ REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 _run_lock = threading.Lock()   # prevent overlapping runs
 _scheduler = BackgroundScheduler()
 _config = cfg.load()
-_conn = db.get_conn(_config['db_path'])
-db.init_db(_config['db_path'])
+# Opens connections lazily; lifespan migrates the DB first, so importing this
+# module (e.g. from tests or bench.py) never touches the configured DB.
+_pool = ConnectionPool(_config['db_path'])
+# Threads for the routes' blocking work (SQLite, template rendering, git), so
+# none of it runs on the event loop. Each keeps its own pooled connection.
+# More threads only contend for the GIL with the loop (see bench.py serve).
+_db_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='db')
+_clients = pipeline.Clients(_config)  # Gmail/Dropbox clients; only used under _run_lock
+_live = LiveLog()  # log of the run in progress, for /run/{run_id}/events
 
 # Last daily summary attempt: {'sent_at', 'subject', 'body'} or {'skipped_at', 'reason'}
 _last_summary: dict | None = None
 
 templates = Jinja2Templates(directory='templates')
 
+LOG_PAGE_SIZE = 500  # run log lines shown per page on /run/{run_id}
+SSE_KEEPALIVE_SECONDS = 15  # comment sent on idle event streams so proxies keep them open
+
 
 def _git_info() -> dict:
     try:
@@ -54,6 +74,27 @@ def _reschedule(interval_minutes: int):
     _scheduler.add_job(_do_run, 'interval', minutes=interval_minutes, jitter=300, id='fetch')
 
 
+def _on_job_submitted(event):
+    # How late the scheduler handed each due run of a job to its thread pool.
+    now = datetime.now(timezone.utc)
+    for planned in event.scheduled_run_times:
+        metrics.SCHEDULER_LAG.observe(max((now - planned).total_seconds(), 0), job=event.job_id)
+
+
+@contextmanager
+def _run_lock_held(job: str):
+    """Hold _run_lock, waiting for it if needed, and record any wait."""
+    start = time.perf_counter()
+    if not _run_lock.acquire(blocking=False):
+        metrics.RUN_LOCK_CONTENDED.inc(job=job)
+        _run_lock.acquire()
+    metrics.RUN_LOCK_WAIT.observe(time.perf_counter() - start, job=job)
+    try:
+        yield
+    finally:
+        _run_lock.release()
+
+
 def _send_daily_summary():
     global _last_summary
     conf = _config
@@ -68,19 +109,10 @@ def _send_daily_summary():
         return
 
     since = (datetime.now(timezone.utc) - timedelta(hours=24)).isoformat()
-    runs = db.get_runs_since(_conn, since)
-    if not runs:
-        _skip('no successful runs with transactions in the past 24 hours')
-        return
-
-    transactions = []
-    for run in runs:
-        if run['added_transactions']:
-            transactions.extend(json.loads(run['added_transactions']))
-
+    transactions = db.get_transactions_added_since(_pool.get(), since)
     count = len(transactions)
     if count == 0:
-        _skip('runs found but added_transactions lists were all empty')
+        _skip('no transactions added in the past 24 hours')
         return
 
     lines = [f'{count} new transaction{"s" if count != 1 else ""} in the past 24 hours:\n']
@@ -91,7 +123,9 @@ def _send_daily_summary():
 
     body = '\n'.join(lines)
     subject = f'Spent: {count} new transaction{"s" if count != 1 else ""}'
-    pipeline.send_email(conf, conf['summary_to'], subject, body)
+    # Waits for a run in progress, which may be using the same Gmail service.
+    with _run_lock_held('summary'):
+        pipeline.send_email(conf, conf['summary_to'], subject, body, _clients)
     print(f'Daily summary sent to {conf["summary_to"]}: {count} transaction(s)')
     _last_summary = {
         'sent_at': datetime.now(timezone.utc).isoformat(),
@@ -102,12 +136,22 @@ def _send_daily_summary():
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    await _blocking(db.init_db, _config['db_path'])
+    interrupted = await _db(db.fail_interrupted_runs)
+    if interrupted:
+        print(f'Marked {interrupted} interrupted run(s) as errors')
     _reschedule(_config['fetch_interval_minutes'])
     _scheduler.add_job(_send_daily_summary, 'cron',
                        hour=_config['summary_hour'], minute=0, id='summary')
+    if _config['dropbox_delta_mode']:
+        _scheduler.add_job(_do_compact, 'cron',
+                           hour=_config['dropbox_compact_hour'], minute=30, id='compact')
+    _scheduler.add_listener(_on_job_submitted, EVENT_JOB_SUBMITTED)
     _scheduler.start()
     yield
     _scheduler.shutdown()
+    _db_executor.shutdown()
+    _pool.close_all()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -115,16 +159,46 @@ app = FastAPI(lifespan=lifespan)
 
 # ── Pipeline runner ────────────────────────────────────────────────────────────
 
-def _do_run():
+def _do_run(backfill: bool = False):
     if not _run_lock.acquire(blocking=False):
+        metrics.RUN_LOCK_CONTENDED.inc(job='fetch')
         return  # already running
     try:
-        pipeline.run(_conn, _config, print)
+        pipeline.run(_pool.get(), _config, print, backfill=backfill, clients=_clients,
+                     on_event=_live.publish)
     finally:
         _run_lock.release()
 
 
+def _do_compact():
+    # Waits for a run in progress: both write transactions.json.
+    with _run_lock_held('compact'):
+        try:
+            pipeline.compact_dropbox(
+                _clients.dropbox(), _config['dropbox_path'], print,
+                pipeline.DropboxCache(_pool.get(), _config['dropbox_cache_file']))
+        except Exception as e:
+            _clients.forget(e)
+            raise
+
+
 # ── Routes ────────────────────────────────────────────────────────────────────
+# Handlers are async, so anything blocking goes through _db() or _blocking().
+
+async def _blocking(fn, *args):
+    """fn(*args) on _db_executor."""
+    return await asyncio.get_running_loop().run_in_executor(_db_executor, fn, *args)
+
+
+async def _db(fn, *args):
+    """fn(conn, *args) on _db_executor, with that thread's pooled connection."""
+    return await _blocking(lambda: fn(_pool.get(), *args))
+
+
+async def _render(request: Request, name: str, context: dict):
+    # A run page can list thousands of emails; rendering it is blocking work too.
+    return await _blocking(templates.TemplateResponse, request, name, context)
+
 
 def _is_running() -> bool:
     acquired = _run_lock.acquire(blocking=False)
@@ -133,26 +207,49 @@ def _is_running() -> bool:
     return not acquired
 
 
-def _duration(run: dict) -> str:
-    if not run.get('finished_at'):
-        return '—'
-    try:
-        start = datetime.fromisoformat(run['started_at'])
-        end = datetime.fromisoformat(run['finished_at'])
-        secs = int((end - start).total_seconds())
-        return f'{secs}s'
-    except Exception:
-        return '—'
+MAX_RUNS_PAGE_SIZE = 500
+
+
+def _runs_page(conn, before: Optional[int], after: Optional[int], limit: Optional[int]) -> dict:
+    """A page of run summaries plus the cursors for its neighbours.
+
+    Pass `older` as before= for the next page back and `newer` as after= for
+    the one forward; each is None when there is no such page. A cursor that
+    names no run is a 404.
+    """
+    if limit is None:
+        limit = _config['runs_page_size']
+    limit = min(max(limit, 1), MAX_RUNS_PAGE_SIZE)
+    runs, has_more = db.get_runs_page(conn, limit, before_id=before, after_id=after)
+    cursor = after if after is not None else before
+    if not runs and cursor is not None and db.get_run(conn, cursor) is None:
+        raise HTTPException(404, f'No run {cursor}')
+    runs = [dict(r) for r in runs]
+    older = newer = None
+    if runs:
+        # Paging forward (after=) leaves older runs behind it, and paging
+        # back (before=) newer ones.
+        if has_more or after is not None:
+            older = runs[-1]['id']
+        if (has_more and after is not None) or before is not None:
+            newer = runs[0]['id']
+    return {'runs': runs, 'older': older, 'newer': newer, 'limit': limit}
+
+
+@app.get('/runs.json')
+async def runs_json(before: Optional[int] = None, after: Optional[int] = None,
+                    limit: Optional[int] = None):
+    return JSONResponse(await _db(_runs_page, before, after, limit))
 
 
 @app.get('/', response_class=HTMLResponse)
-async def index(request: Request):
-    raw_runs = db.get_recent_runs(_conn)
-    runs = [dict(r) | {'duration': _duration(dict(r))} for r in raw_runs]
+async def index(request: Request, before: Optional[int] = None, after: Optional[int] = None,
+                limit: Optional[int] = None):
+    page = await _db(_runs_page, before, after, limit)
     job = _scheduler.get_job('fetch')
     next_run = job.next_run_time.strftime('%Y-%m-%d %H:%M UTC') if job and job.next_run_time else '—'
-    return templates.TemplateResponse(request, 'index.html', {
-        'runs': runs,
+    return await _render(request, 'index.html', {
+        **page,
         'next_run': next_run,
         'running': _is_running(),
         'git': _git,
@@ -160,14 +257,64 @@ async def index(request: Request):
     })
 
 
-@app.get('/run/{run_id}', response_class=HTMLResponse)
-async def run_detail(request: Request, run_id: int):
-    run = db.get_run(_conn, run_id)
-    emails = db.get_run_emails(_conn, run_id)
-    return templates.TemplateResponse(request, 'run.html', {
+def _breakdown(run: dict, values: dict) -> dict:
+    """Timers (with their share of the run's wall time) and counters for run.html."""
+    try:
+        total = (datetime.fromisoformat(run['finished_at'])
+                 - datetime.fromisoformat(run['started_at'])).total_seconds()
+    except (TypeError, ValueError):
+        total = 0
+    return {
+        'timers': [{'label': label, 'seconds': values[name],
+                    'share': values[name] / total if total > 0 else None}
+                   for name, label in metrics.TIMERS if name in values],
+        'counters': [{'label': label, 'value': int(values[name])}
+                     for name, label in metrics.COUNTERS if name in values],
+    }
+
+
+def _run_detail(conn, run_id: int, log_offset: int) -> dict:
+    run = db.get_run(conn, run_id)
+    return {
         'run': dict(run),
-        'emails': [dict(e) for e in emails],
-    })
+        'breakdown': _breakdown(dict(run), db.get_run_metrics(conn, run_id)),
+        'emails': [dict(e) for e in db.get_run_emails(conn, run_id)],
+        'log': [dict(line) for line in db.get_run_log(conn, run_id, log_offset, LOG_PAGE_SIZE)],
+        'log_total': db.count_run_log(conn, run_id),
+        'log_offset': log_offset,
+        'log_page_size': LOG_PAGE_SIZE,
+    }
+
+
+@app.get('/run/{run_id}', response_class=HTMLResponse)
+async def run_detail(request: Request, run_id: int, log_offset: int = 0):
+    context = await _db(_run_detail, run_id, max(log_offset, 0))
+    return await _render(request, 'run.html', context)
+
+
+@app.get('/run/{run_id}/events')
+async def run_events(run_id: int, after: int = 0):
+    """Server-Sent Events for a run in progress: its log lines numbered from
+    `after` on (see pipeline.RunLogger), stage changes, then 'end'.
+
+    Streamed from _live, not SQLite. A run that isn't in progress gets just
+    its 'end' event, with the status stored for it; that is still 'running'
+    if it was started but has published nothing yet.
+    """
+    async def stream():
+        async for event in _live.subscribe(run_id, after, keepalive=SSE_KEEPALIVE_SECONDS):
+            if event is None:
+                yield ': keepalive\n\n'
+                continue
+            yield f'event: {event["type"]}\ndata: {json.dumps(event)}\n\n'
+            if event['type'] == 'end':
+                return
+        run = await _db(db.get_run, run_id)
+        status = run['status'] if run else 'unknown'
+        yield f'event: end\ndata: {json.dumps({"type": "end", "status": status})}\n\n'
+
+    return StreamingResponse(stream(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache'})
 
 
 @app.get('/ping')
@@ -175,22 +322,34 @@ async def ping():
     return 'pong'
 
 
+@app.get('/metrics', response_class=PlainTextResponse)
+async def prometheus_metrics():
+    # In-process totals only (see metrics.py); nothing is read from the DB.
+    return PlainTextResponse(metrics.exposition(), media_type='text/plain; version=0.0.4')
+
+
 @app.post('/fetch')
 async def fetch_now():
     threading.Thread(target=_do_run, daemon=True).start()
     return RedirectResponse('/', status_code=303)
 
 
+@app.post('/backfill')
+async def backfill():
+    threading.Thread(target=_do_run, kwargs={'backfill': True}, daemon=True).start()
+    return RedirectResponse('/', status_code=303)
+
+
 @app.post('/reparse')
 async def reparse():
-    count = db.reset_parsed_emails(_conn)
+    count = await _db(db.reset_stale_emails, parsers.current_versions())
     threading.Thread(target=_do_run, daemon=True).start()
     return RedirectResponse(f'/?reparsing={count}', status_code=303)
 
 
 @app.post('/reparse/{run_id}')
 async def reparse_run(run_id: int):
-    count = db.reset_parsed_emails_for_run(_conn, run_id)
+    count = await _db(db.reset_parsed_emails_for_run, run_id)
     threading.Thread(target=_do_run, daemon=True).start()
     return RedirectResponse(f'/run/{run_id}?reparsing={count}', status_code=303)
 
@@ -223,14 +382,14 @@ setTimeout(poll, 2000);
 
 @app.post('/update')
 async def update():
-    result = subprocess.run(
+    result = await _blocking(lambda: subprocess.run(
         ['git', 'pull'], cwd=REPO_ROOT, capture_output=True, text=True,
-    )
+    ))
     if result.returncode == 0:
         changed = 'Already up to date' not in result.stdout
-        git_hash = subprocess.check_output(
+        git_hash = (await _blocking(lambda: subprocess.check_output(
             ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, text=True
-        ).strip()
+        ))).strip()
         subprocess.Popen(['sudo', 'systemctl', 'restart', 'fetch-server'])
         return HTMLResponse(_restarting_html(git_hash, changed))
     return RedirectResponse('/?update=fail', status_code=303)
@@ -1,4 +1,6 @@
 """Unit tests for db.py helper functions."""
+import base64
+import json
 from datetime import datetime, timedelta, timezone
 
 import pytest
@@ -6,14 +8,6 @@ import pytest
 import db
 
 
-@pytest.fixture
-def conn(tmp_path):
-    c = db.get_conn(str(tmp_path / 'test.db'))
-    c.executescript(db.SCHEMA)
-    yield c
-    c.close()
-
-
 def _tx(id, date='2026-04-27', description='STORE'):
     return {
         'id': id,
@@ -30,60 +24,363 @@ def _tx(id, date='2026-04-27', description='STORE'):
 
 # ── get_recently_added_transactions ───────────────────────────────────────────
 
-def test_recently_added_empty_when_no_runs(conn):
+def _add(conn, *ids, days_ago=0):
+    """Store, parse and mark ids as added to Dropbox `days_ago` days ago."""
+    run_id = db.start_run(conn)
+    db.save_emails_many(conn, [(i, b'raw', 's', 'f') for i in ids], run_id)
+    db.save_transactions_many(conn, [_tx(i) for i in ids])
+    db.mark_transactions_added(conn, list(ids))
+    added_at = (datetime.now(timezone.utc) - timedelta(days=days_ago)).isoformat()
+    conn.executemany('UPDATE transactions SET added_at = ? WHERE gmail_id = ?',
+                     [(added_at, i) for i in ids])
+    conn.commit()
+
+
+def test_recently_added_empty_when_nothing_added(conn):
     assert db.get_recently_added_transactions(conn) == []
 
 
-def test_recently_added_returns_transactions_from_successful_run(conn):
-    run_id = db.start_run(conn)
-    db.finish_run(conn, run_id, 'success', added_transactions=[_tx('a'), _tx('b')])
-    result = db.get_recently_added_transactions(conn)
-    assert [t['id'] for t in result] == ['a', 'b']
+def test_recently_added_returns_added_transactions(conn):
+    _add(conn, 'a', 'b')
+    assert db.get_recently_added_transactions(conn) == [_tx('a'), _tx('b')]
 
 
-def test_recently_added_excludes_failed_runs(conn):
+def test_recently_added_excludes_parsed_but_never_added(conn):
     run_id = db.start_run(conn)
-    db.finish_run(conn, run_id, 'error', added_transactions=[_tx('a')])
+    db.save_emails_many(conn, [('a', b'raw', 's', 'f')], run_id)
+    db.save_transactions_many(conn, [_tx('a')])
     assert db.get_recently_added_transactions(conn) == []
 
 
-def test_recently_added_excludes_runs_with_no_transactions(conn):
+def test_recently_added_once_when_added_again(conn):
+    _add(conn, 'a', days_ago=3)
+    db.mark_transactions_added(conn, ['a'])
+    assert [t['id'] for t in db.get_recently_added_transactions(conn)] == ['a']
+
+
+def test_recently_added_excludes_older_than_days(conn):
+    _add(conn, 'old', days_ago=8)
+    assert db.get_recently_added_transactions(conn, days=7) == []
+
+
+def test_recently_added_includes_inside_window(conn):
+    _add(conn, 'edge', days_ago=6)
+    assert [t['id'] for t in db.get_recently_added_transactions(conn, days=7)] == ['edge']
+
+
+def test_transactions_added_since_oldest_first(conn):
+    _add(conn, 'b', days_ago=1)
+    _add(conn, 'a', days_ago=2)
+    since = (datetime.now(timezone.utc) - timedelta(days=3)).isoformat()
+    assert [t['id'] for t in db.get_transactions_added_since(conn, since)] == ['a', 'b']
+
+
+# ── transaction ───────────────────────────────────────────────────────────────
+
+def _email_count(path) -> int:
+    other = db.get_conn(path)
+    try:
+        return other.execute('SELECT COUNT(*) FROM emails').fetchone()[0]
+    finally:
+        other.close()
+
+
+def test_transaction_defers_helper_commits_until_exit(tmp_path, conn):
+    path = str(tmp_path / 'test.db')
     run_id = db.start_run(conn)
-    db.finish_run(conn, run_id, 'success')  # added_transactions omitted
-    assert db.get_recently_added_transactions(conn) == []
+    with db.transaction(conn):
+        db.save_email(conn, 'a', b'raw', 'subject', 'from', run_id)
+        db.save_emails_many(conn, [('b', b'raw', 'subject', 'from')], run_id)
+        assert _email_count(path) == 0
+    assert _email_count(path) == 2
 
 
-def test_recently_added_deduplicates_across_runs(conn):
-    run1 = db.start_run(conn)
-    db.finish_run(conn, run1, 'success', added_transactions=[_tx('a')])
-    run2 = db.start_run(conn)
-    db.finish_run(conn, run2, 'success', added_transactions=[_tx('a'), _tx('b')])
+def test_transaction_rolls_back_on_error(conn):
+    run_id = db.start_run(conn)
+    with pytest.raises(RuntimeError):
+        with db.transaction(conn):
+            db.save_email(conn, 'a', b'raw', 'subject', 'from', run_id)
+            raise RuntimeError('boom')
+    assert db.seen_email_ids(conn, ['a']) == set()
 
-    result = db.get_recently_added_transactions(conn)
-    ids = [t['id'] for t in result]
-    assert ids.count('a') == 1
-    assert 'b' in ids
+
+def test_nested_transaction_commits_with_outermost(tmp_path, conn):
+    path = str(tmp_path / 'test.db')
+    run_id = db.start_run(conn)
+    with db.transaction(conn):
+        with db.transaction(conn):
+            db.save_email(conn, 'a', b'raw', 'subject', 'from', run_id)
+        assert _email_count(path) == 0
+    assert _email_count(path) == 1
 
 
-def test_recently_added_excludes_runs_older_than_days(conn):
+def test_reset_stale_emails(conn):
     run_id = db.start_run(conn)
-    db.finish_run(conn, run_id, 'success', added_transactions=[_tx('old')])
-    # Backdate to 8 days ago, outside the default 7-day window.
-    old_ts = (datetime.now(timezone.utc) - timedelta(days=8)).isoformat()
-    conn.execute('UPDATE fetch_runs SET started_at = ? WHERE id = ?', (old_ts, run_id))
-    conn.commit()
+    db.save_emails_many(conn, [(i, b'raw', 's', 'f') for i in 'abcdef'], run_id)
+    db.mark_parsed_many(conn, [('a', 'chase:new'), ('b', 'chase:old'), ('c', 'usaa:new'),
+                               ('d', None)])
+    db.mark_errors_many(conn, [('e', 'bad format')])
 
-    assert db.get_recently_added_transactions(conn, days=7) == []
+    assert db.reset_stale_emails(conn, ['chase:new', 'usaa:new']) == 3
+    statuses = {r['gmail_id']: r['parse_status'] for r in db.get_run_emails(conn, run_id)}
+    assert statuses == {'a': 'parsed', 'b': 'pending', 'c': 'parsed',
+                        'd': 'pending', 'e': 'pending', 'f': 'pending'}
 
 
-def test_recently_added_includes_run_at_boundary(conn):
+def test_mark_parsed_and_errors_many(conn):
     run_id = db.start_run(conn)
-    db.finish_run(conn, run_id, 'success', added_transactions=[_tx('edge')])
-    # Backdate to exactly 6 days ago — still within the 7-day window.
-    recent_ts = (datetime.now(timezone.utc) - timedelta(days=6)).isoformat()
-    conn.execute('UPDATE fetch_runs SET started_at = ? WHERE id = ?', (recent_ts, run_id))
-    conn.commit()
+    db.save_emails_many(conn, [(i, b'raw', 's', 'f') for i in ('a', 'b', 'c')], run_id)
+    db.mark_parsed_many(conn, [('a', 'chase:1'), ('b', 'chase:1')])
+    db.mark_errors_many(conn, [('c', 'bad format')])
+
+    rows = {r['gmail_id']: r for r in db.get_run_emails(conn, run_id)}
+    assert rows['a']['parse_status'] == 'parsed'
+    assert conn.execute(
+        "SELECT parser_version FROM emails WHERE gmail_id = 'a'").fetchone()[0] == 'chase:1'
+    assert rows['b']['parse_status'] == 'parsed'
+    assert rows['c']['parse_status'] == 'error'
+    assert rows['c']['parse_error'] == 'bad format'
+    assert [r['gmail_id'] for r in next(db.iter_emails_pending_parse(conn))] == ['c']
+
+
+# ── run log ───────────────────────────────────────────────────────────────────
+
+def test_run_log_is_paginated_in_insertion_order(conn):
+    run_id = db.start_run(conn)
+    db.append_log_many(conn, run_id, [('2026-04-27T00:00:00', 'info', 'parse', f'line {i}')
+                                      for i in range(10)])
+    db.append_log(conn, run_id, 'boom', level='error', stage='dropbox')
+
+    assert db.count_run_log(conn, run_id) == 11
+    page = db.get_run_log(conn, run_id, offset=8, limit=5)
+    assert [r['line'] for r in page] == ['line 8', 'line 9', 'boom']
+    assert (page[2]['level'], page[2]['stage']) == ('error', 'dropbox')
+
+
+def test_runs_page_does_not_load_log_or_added_transactions(conn):
+    run_id = db.start_run(conn)
+    db.finish_run(conn, run_id, 'success', transactions_added=1)
+    row = db.get_runs_page(conn)[0][0]
+    assert 'log' not in row.keys()
+    assert 'added_transactions' not in row.keys()
+
+
+def test_runs_page_walks_runs_newest_first(conn):
+    ids = [db.start_run(conn) for _ in range(5)]
+    for run_id in ids[:-1]:
+        db.finish_run(conn, run_id, 'success')
+
+    runs, has_more = db.get_runs_page(conn, limit=2)
+    assert ([r['id'] for r in runs], has_more) == (ids[:2:-1], True)
+    runs, has_more = db.get_runs_page(conn, limit=2, before_id=ids[3])
+    assert ([r['id'] for r in runs], has_more) == ([ids[2], ids[1]], True)
+    runs, has_more = db.get_runs_page(conn, limit=2, before_id=ids[1])
+    assert ([r['id'] for r in runs], has_more) == ([ids[0]], False)
+    runs, has_more = db.get_runs_page(conn, limit=2, after_id=ids[1])
+    assert ([r['id'] for r in runs], has_more) == ([ids[3], ids[2]], True)
+
+
+def test_runs_page_computes_duration(conn):
+    run_id = db.start_run(conn)
+    conn.execute("UPDATE fetch_runs SET started_at = '2026-04-01T10:00:00.250000+00:00' WHERE id = ?",
+                 (run_id,))
+    (running,), _ = db.get_runs_page(conn)
+    conn.execute("UPDATE fetch_runs SET finished_at = '2026-04-01T10:01:05.100000+00:00' WHERE id = ?",
+                 (run_id,))
+    (finished,), _ = db.get_runs_page(conn)
+
+    assert running['duration_seconds'] is None
+    assert finished['duration_seconds'] == 64
+
 
-    result = db.get_recently_added_transactions(conn, days=7)
-    assert len(result) == 1
-    assert result[0]['id'] == 'edge'
+def test_runs_page_duration_of_exact_seconds(conn):
+    run_id = db.start_run(conn)
+    start = datetime(2026, 4, 1, 10, tzinfo=timezone.utc)
+    conn.execute('UPDATE fetch_runs SET started_at = ? WHERE id = ?', (start.isoformat(), run_id))
+    wrong = []
+    for seconds in range(3600):
+        conn.execute('UPDATE fetch_runs SET finished_at = ? WHERE id = ?',
+                     ((start + timedelta(seconds=seconds)).isoformat(), run_id))
+        (run,), _ = db.get_runs_page(conn)
+        if run['duration_seconds'] != seconds:
+            wrong.append(seconds)
+    assert wrong == []
+
+
+def test_runs_page_keyset_uses_started_at_index(conn):
+    for before, after in [(1, None), (None, 1)]:
+        plans = _query_plans(conn, db.get_runs_page, 50, before, after)
+        assert 'idx_fetch_runs_started_at' in plans[0][0], plans
+        assert not any('TEMP B-TREE' in step for step in plans[0]), plans
+
+
+def _transaction(gmail_id: str, date: str) -> dict:
+    return {'id': gmail_id, 'description': 'SHOP', 'original_line': 'Alert', 'date': date,
+            'tags': [], 'amount_cents': 100, 'transactions': [], 'source': 'email_chase',
+            'notes': ''}
+
+
+def test_transactions_round_trip(conn):
+    run_id = db.start_run(conn)
+    db.save_emails_many(conn, [(i, b'raw', 's', 'f') for i in 'abc'], run_id)
+    db.save_transactions_many(conn, [_transaction('a', '2026-04-01'),
+                                     _transaction('b', '2026-04-15'),
+                                     _transaction('c', '2026-05-01')])
+    db.delete_transactions(conn, ['a'])
+
+    assert db.get_transactions_between(conn, '2026-04-01', '2026-04-30') == \
+        [_transaction('b', '2026-04-15')]
+    rows = {r['gmail_id']: r for r in db.get_run_emails(conn, run_id)}
+    assert rows['a']['date'] is None
+    assert (rows['c']['date'], rows['c']['amount_cents']) == ('2026-05-01', 100)
+
+
+# ── migrations ────────────────────────────────────────────────────────────────
+
+def test_init_db_applies_all_migrations_once(tmp_path):
+    path = str(tmp_path / 'test.db')
+    db.init_db(path)
+    db.init_db(path)
+    c = db.get_conn(path)
+    assert c.execute('PRAGMA user_version').fetchone()[0] == len(db.MIGRATIONS)
+    c.close()
+
+
+def test_migrate_upgrades_db_predating_added_transactions(tmp_path):
+    path = str(tmp_path / 'test.db')
+    c = db.get_conn(path)
+    c.executescript(db.SCHEMA.replace(
+        ',\n    added_transactions  TEXT     -- superseded by transactions.added_at; always NULL',
+        ''))
+    c.close()
+
+    db.init_db(path)
+    c = db.get_conn(path)
+    columns = {row['name'] for row in c.execute('PRAGMA table_info(fetch_runs)')}
+    assert 'added_transactions' in columns
+    c.close()
+
+
+def test_migrate_marks_parsed_emails_stale_for_transactions_table(tmp_path):
+    path = str(tmp_path / 'test.db')
+    db.init_db(path)
+    c = db.get_conn(path)
+    run_id = db.start_run(c)
+    db.save_emails_many(c, [('a', b'raw', 's', 'f')], run_id)
+    db.mark_parsed_many(c, [('a', 'chase:1')])
+    c.execute('DROP TABLE transactions')
+    c.execute(f'PRAGMA user_version = {db.MIGRATIONS.index(db._add_transactions_table)}')
+    c.commit()
+    c.close()
+
+    db.init_db(path)
+    c = db.get_conn(path)
+    assert db.reset_stale_emails(c, ['chase:1']) == 1
+    c.close()
+
+
+def test_migrate_moves_added_transactions_lists(tmp_path):
+    path = str(tmp_path / 'test.db')
+    db.init_db(path)
+    c = db.get_conn(path)
+    run_id = db.start_run(c)
+    db.save_emails_many(c, [(i, b'raw', 's', 'f') for i in 'ab'], run_id)
+    db.save_transactions_many(c, [_tx('b')])
+    c.execute('DROP INDEX idx_transactions_added_at')
+    c.execute('ALTER TABLE transactions DROP COLUMN added_at')
+    now = datetime.now(timezone.utc)
+    for days_ago, ids in [(2, 'ab'), (1, 'b'), (0, 'x')]:  # no email for x
+        c.execute(
+            """INSERT INTO fetch_runs (started_at, status, added_transactions)
+               VALUES (?, 'success', ?)""",
+            ((now - timedelta(days=days_ago)).isoformat(), json.dumps([_tx(i) for i in ids])))
+    c.execute(f'PRAGMA user_version = {db.MIGRATIONS.index(db._add_transactions_added_at)}')
+    c.commit()
+    c.close()
+
+    db.init_db(path)
+    c = db.get_conn(path)
+    assert db.get_recently_added_transactions(c) == [_tx('a'), _tx('b')]
+    added_at = dict(c.execute('SELECT gmail_id, added_at FROM transactions'))
+    assert added_at['b'][:10] == (now - timedelta(days=1)).isoformat()[:10]
+    assert c.execute('SELECT COUNT(*) FROM fetch_runs WHERE added_transactions IS NOT NULL'
+                     ).fetchone()[0] == 0
+    c.close()
+
+
+# ── query plans ───────────────────────────────────────────────────────────────
+
+def _query_plans(conn, fn, *args) -> list:
+    """Run fn and return the EXPLAIN QUERY PLAN steps of each SELECT it issued."""
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        fn(conn, *args)
+    finally:
+        conn.set_trace_callback(None)
+    plans = []
+    for sql in statements:
+        if sql.lstrip().upper().startswith('SELECT'):
+            rows = conn.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+            plans.append([row['detail'] for row in rows])
+    return plans
+
+
+@pytest.mark.parametrize('fn, args', [
+    (db.get_runs_page, ()),
+    (db.get_recently_added_transactions, ()),
+    (db.get_transactions_added_since, ('2026-01-01',)),
+    (db.get_run_emails, (1,)),
+    (db.get_run_log, (1,)),
+    (db.get_transactions_between, ('2026-04-01', '2026-04-30')),
+    (lambda conn: list(db.iter_emails_pending_parse(conn)), ()),
+])
+def test_hot_queries_use_an_index(conn, fn, args):
+    plans = _query_plans(conn, fn, *args)
+    assert plans
+    for plan in plans:
+        for step in plan:
+            # Scanning a (partial) index is fine; scanning a whole table or
+            # sorting into a temp b-tree is not.
+            assert 'INDEX' in step, plan
+            assert 'TEMP B-TREE' not in step, plan
+
+
+def test_migrate_moves_log_blobs_into_run_log(tmp_path):
+    path = str(tmp_path / 'test.db')
+    c = db.get_conn(path)
+    c.executescript(db.SCHEMA)
+    c.execute("INSERT INTO fetch_runs (started_at, log) VALUES ('2026-04-27', 'one\ntwo\n')")
+    c.execute('PRAGMA user_version = 2')
+    c.commit()
+    c.close()
+
+    db.init_db(path)
+    c = db.get_conn(path)
+    assert [r['line'] for r in db.get_run_log(c, 1)] == ['one', 'two']
+    assert db.get_run(c, 1)['log'] == ''
+    c.close()
+
+
+def test_migrate_compresses_stored_emails(tmp_path):
+    path = str(tmp_path / 'test.db')
+    message = b'From: noreply@chase.com\r\nSubject: Alert\r\n\r\n' + b'<td>body</td>' * 500
+    c = db.get_conn(path)
+    c.executescript(db.SCHEMA)
+    c.execute("INSERT INTO fetch_runs (started_at) VALUES ('2026-04-27')")
+    c.execute(
+        """INSERT INTO emails (gmail_id, raw_content, subject, downloaded_at, fetch_run_id)
+           VALUES ('a', ?, 'Alert', '2026-04-27', 1)""",
+        (base64.urlsafe_b64encode(message).decode(),))
+    c.execute('PRAGMA user_version = 3')
+    c.commit()
+    c.close()
+
+    db.init_db(path)
+    c = db.get_conn(path)
+    (row,) = next(db.iter_emails_pending_parse(c))
+    assert row['gmail_id'] == 'a'
+    assert len(row['raw']) < len(message) / 10
+    assert db.unpack_raw(row['raw']) == message
+    assert db.get_run_emails(c, 1)[0]['subject'] == 'Alert'
+    c.close()
@@ -0,0 +1,70 @@
+"""Tests for the in-memory run log fan-out in live.py."""
+import asyncio
+import threading
+
+from live import LiveLog
+
+
+def _line(n: int) -> dict:
+    return {'type': 'line', 'n': n, 'line': f'line {n}'}
+
+
+async def _collect(live: LiveLog, run_id: int, after: int = 0, **kwargs) -> list:
+    return [e async for e in live.subscribe(run_id, after, **kwargs)]
+
+
+def test_subscriber_gets_missed_lines_then_live_ones():
+    live = LiveLog()
+    for n in range(3):
+        live.publish(1, _line(n))
+
+    async def main():
+        task = asyncio.create_task(_collect(live, 1, after=1))
+        await asyncio.sleep(0.01)
+        # Published from another thread, like the pipeline does.
+        t = threading.Thread(target=lambda: (live.publish(1, _line(3)),
+                                             live.publish(1, {'type': 'end', 'status': 'success'})))
+        t.start()
+        t.join()
+        return await asyncio.wait_for(task, 1)
+
+    events = asyncio.run(main())
+    assert [e.get('n') for e in events] == [1, 2, 3, None]
+    assert events[-1]['status'] == 'success'
+    assert not live._subscribers
+
+
+def test_subscriber_to_other_run_gets_nothing():
+    live = LiveLog()
+    live.publish(2, _line(0))
+    assert asyncio.run(_collect(live, 1)) == []
+
+
+def test_finished_run_replays_backlog_and_end():
+    live = LiveLog()
+    live.publish(1, _line(0))
+    live.publish(1, {'type': 'end', 'status': 'error'})
+    assert [e['type'] for e in asyncio.run(_collect(live, 1))] == ['line', 'end']
+
+
+def test_new_run_clears_backlog():
+    live = LiveLog()
+    live.publish(1, _line(0))
+    live.publish(2, _line(0))
+    live.publish(2, {'type': 'end', 'status': 'success'})
+    assert len(asyncio.run(_collect(live, 2))) == 2
+    assert asyncio.run(_collect(live, 1)) == []
+
+
+def test_keepalive_while_idle():
+    live = LiveLog()
+    live.publish(1, _line(0))
+
+    async def main():
+        events = live.subscribe(1, 1, keepalive=0.01)
+        first = await events.__anext__()
+        await events.aclose()
+        return first
+
+    assert asyncio.run(main()) is None
+    assert not live._subscribers
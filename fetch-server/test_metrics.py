@@ -0,0 +1,70 @@
+"""Unit tests for per-run metrics and the Prometheus exposition in metrics.py."""
+import sqlite3
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def families(monkeypatch):
+    """Keep families a test defines out of the real exposition."""
+    monkeypatch.setattr(metrics, '_families', [])
+
+
+def test_counter_exposition(families):
+    c = metrics.Counter('x_total', 'Things.', ['kind'])
+    c.inc(kind='a')
+    c.inc(2, kind='b"q')
+    c.inc(kind='a')
+
+    assert metrics.exposition() == (
+        '# HELP x_total Things.\n'
+        '# TYPE x_total counter\n'
+        'x_total{kind="a"} 2\n'
+        'x_total{kind="b\\"q"} 2\n'
+    )
+
+
+def test_unlabelled_counter_starts_at_zero(families):
+    metrics.Counter('y_total', 'Things.')
+    assert metrics.exposition().endswith('y_total 0\n')
+
+
+def test_histogram_buckets_are_cumulative(families):
+    h = metrics.Histogram('lag_seconds', 'Lag.', buckets=(1, 5))
+    for value in (0.5, 2, 7):
+        h.observe(value)
+
+    assert metrics.exposition().splitlines()[2:] == [
+        'lag_seconds_bucket{le="1"} 1',
+        'lag_seconds_bucket{le="5"} 2',
+        'lag_seconds_bucket{le="+Inf"} 3',
+        'lag_seconds_sum 9.5',
+        'lag_seconds_count 3',
+    ]
+
+
+def test_wrong_labels_raise(families):
+    c = metrics.Counter('z_total', 'Things.', ['kind'])
+    with pytest.raises(ValueError):
+        c.inc(other='a')
+
+
+def test_recording_folds_run_into_totals():
+    conn = sqlite3.connect(':memory:')
+    runs = metrics.RUNS.value(status='error')
+    stage_count = metrics.STAGE_SECONDS.count(stage='parse')
+
+    with pytest.raises(RuntimeError):
+        with metrics.recording(conn) as run:
+            with metrics.timer('parse'):
+                conn.execute('SELECT 1')
+            metrics.add('dropbox_bytes_up', 10)
+            raise RuntimeError
+
+    assert run.values['sqlite_statements'] == 1
+    assert metrics.RUNS.value(status='error') == runs + 1
+    assert metrics.STAGE_SECONDS.count(stage='parse') == stage_count + 1
+    metrics.add('parse', 1)  # outside a run: ignored
+    assert run.values['parse'] < 1
@@ -0,0 +1,112 @@
+"""Unit tests for the bank format registry in parsers.py."""
+import email as email_lib
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import pytest
+
+import parsers
+from parsers import BankFormat, find_format
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Let a test register formats without leaking them into other tests."""
+    monkeypatch.setattr(parsers, 'FORMATS', list(parsers.FORMATS))
+    monkeypatch.setattr(parsers, '_by_domain', dict(parsers._by_domain))
+    monkeypatch.setattr(parsers, '_by_subject', dict(parsers._by_subject))
+    monkeypatch.setattr(parsers, '_domain_re', parsers._domain_re)
+    monkeypatch.setattr(parsers, '_subject_re', parsers._subject_re)
+
+
+# ── Dispatch ───────────────────────────────────────────────────────────────────
+
+@pytest.mark.parametrize('from_addr,subject,name', [
+    ('Chase <no.reply.alerts@chase.com>', 'Your transaction', 'chase'),
+    ('alerts@jpmorgan.com', 'Deposit to Your Bank Account', 'jpmorgan'),
+    ('USAA <usaa.customer.service@mailcenter.usaa.com>',
+     'USAA: Your Bank Account Received a Deposit', 'usaa_deposit'),
+    ('usaa@usaa.com', 'Deposit to Your Bank Account', 'usaa_deposit2'),
+    ('usaa@usaa.com', 'Debit Alert for Your USAA Bank Account', 'usaa_debit'),
+])
+def test_find_format(from_addr, subject, name):
+    assert find_format(from_addr, subject).name == name
+
+
+def test_find_format_unknown():
+    assert find_format('someone@example.com', 'Hello') is None
+
+
+def test_registered_format_is_dispatched(registry):
+    fmt = parsers.register(BankFormat(
+        'example', 'email_example',
+        description=r'Payee: (?P<description>[A-Z ]+)',
+        amount=r'Paid [$](?P<amount>[0-9.,]+)',
+    ), from_domain='bank.example')
+    raw = (b'From: alerts@bank.example\r\nSubject: Payment\r\n\r\n'
+           b'Date: 03/09/26\r\nPayee: CORNER SHOP\r\nPaid $12.50\r\n')
+    t = parsers.parse('id1', raw)
+    assert find_format('alerts@bank.example', '') is fmt
+    assert (t['description'], t['date'], t['amount_cents'], t['source']) == \
+        ('CORNER SHOP', '2026-03-09', 1250, 'email_example')
+
+
+def test_register_requires_a_matcher(registry):
+    with pytest.raises(ValueError):
+        parsers.register(BankFormat('x', 'email_x', description='(?P<description>x)'))
+
+
+def test_missing_amount_raises_value_error():
+    raw = (b'From: noreply@chase.com\r\nSubject: Alert\r\n\r\n'
+           b"> Apr 27, 2026 \r\n>Merchant<x<td class='c'>SHOP</td>\r\n")
+    with pytest.raises(ValueError, match='no amount') as e:
+        parsers.parse('id1', raw)
+    assert e.value.format == 'chase'
+
+
+def test_unknown_format_error_has_no_format():
+    with pytest.raises(parsers.ParseError) as e:
+        parsers.parse('id1', b'From: someone@example.com\r\nSubject: Hi\r\n\r\nbody')
+    assert e.value.format is None
+
+
+# ── Body decoding ──────────────────────────────────────────────────────────────
+
+def test_quoted_printable_body_is_decoded():
+    body = ("> Apr 27, 2026 \r\n"
+            ">Merchant<x<td class=3D'c'>TRADER=C2=A0JOE'S</td>\r\n"
+            ">Amount<x<td class=3D'c'>$4=\r\n5.00</td>\r\n")
+    raw = f'From: noreply@chase.com\r\nSubject: Alert\r\n\r\n{body}'.encode()
+    t = parsers.parse('id1', raw)
+    assert t['description'] == "TRADER JOE'S"
+    assert t['amount_cents'] == 4500
+
+
+@pytest.mark.parametrize('linesep', ['\n', '\r\n'])
+def test_first_part_matches_full_mime_parse(linesep):
+    msg = MIMEMultipart()
+    msg['From'] = 'usaa@usaa.com'
+    msg['Subject'] = 'Debit Alert for Your USAA Bank Account'
+    msg.attach(MIMEText('Date: 04/01/26\nTo: Electric Company\n$150.00 came out of your account\n',
+                        'plain', 'us-ascii'))
+    msg.attach(MIMEText('second part\n', 'plain', 'us-ascii'))
+    text = msg.as_string().replace('\n', linesep)
+
+    headers, body = parsers._split(text)
+    _, part_body = parsers._first_part(headers, body)
+    assert part_body == email_lib.message_from_string(text).get_payload()[0].get_payload()
+
+
+def test_version_tracks_patterns():
+    def fmt(amount):
+        return BankFormat('x', 'email_x', description='(?P<description>x)', amount=amount)
+    assert fmt(r'[$](?P<amount>\d+)').version == fmt(r'[$](?P<amount>\d+)').version
+    assert fmt(r'[$](?P<amount>\d+)').version != fmt(r'[$](?P<amount>[0-9.]+)').version
+    assert fmt(r'[$](?P<amount>\d+)').version.startswith('x:')
+
+
+def test_parse_versioned_reports_format_version():
+    raw = (b'From: noreply@chase.com\r\nSubject: Alert\r\n\r\n'
+           b"> Apr 27, 2026 \r\n>Merchant<x<td class='c'>SHOP</td>\r\n>Amount<x<td class='c'>$1.00</td>\r\n")
+    _, version = parsers.parse_versioned('id1', raw)
+    assert version == find_format('noreply@chase.com', '').version
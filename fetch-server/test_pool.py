@@ -0,0 +1,107 @@
+"""Concurrency tests for the per-thread connection pool."""
+import threading
+import time
+
+import pytest
+
+import db
+from pool import ConnectionPool
+
+
+@pytest.fixture
+def pool(db_path):
+    p = ConnectionPool(db_path)
+    yield p
+    p.close_all()
+
+
+def _in_thread(fn):
+    result = []
+    t = threading.Thread(target=lambda: result.append(fn()))
+    t.start()
+    t.join()
+    return result[0]
+
+
+def test_one_connection_per_thread(pool):
+    conn = pool.get()
+    assert pool.get() is conn
+    assert _in_thread(pool.get) is not conn
+
+
+def test_connections_are_tuned(pool):
+    conn = pool.get()
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+    assert conn.execute('PRAGMA busy_timeout').fetchone()[0] == db.BUSY_TIMEOUT_MS
+
+
+def test_reads_do_not_block_behind_open_write_transaction(pool):
+    in_transaction = threading.Event()
+    release = threading.Event()
+
+    def writer():
+        conn = pool.get()
+        with db.transaction(conn):
+            run_id = db.start_run(conn)
+            db.append_log(conn, run_id, 'working')
+            in_transaction.set()
+            release.wait(5)
+
+    t = threading.Thread(target=writer)
+    t.start()
+    try:
+        assert in_transaction.wait(5)
+        start = time.monotonic()
+        runs = db.get_runs_page(pool.get())[0]
+        assert time.monotonic() - start < 1
+        assert runs == []  # the uncommitted run isn't visible yet
+    finally:
+        release.set()
+        t.join()
+    assert len(db.get_runs_page(pool.get())[0]) == 1
+
+
+def test_reads_hammered_during_simulated_run(pool):
+    errors = []
+    reads = []
+    done = threading.Event()
+
+    def simulated_run():
+        try:
+            conn = pool.get()
+            for batch in range(20):
+                with db.transaction(conn):
+                    run_id = db.start_run(conn)
+                    db.save_emails_many(
+                        conn, [(f'{batch}-{i}', b'raw', 's', 'f') for i in range(25)], run_id)
+                    for i in range(25):
+                        db.append_log(conn, run_id, f'Downloaded {batch}-{i}')
+                db.mark_parsed_many(conn, [(f'{batch}-{i}', 'chase:1') for i in range(25)])
+                db.finish_run(conn, run_id, 'success', emails_downloaded=25)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            done.set()
+
+    def reader():
+        try:
+            conn = pool.get()
+            while not done.is_set():
+                for run in db.get_runs_page(conn)[0]:
+                    db.get_run(conn, run['id'])
+                    db.get_run_emails(conn, run['id'])
+                reads.append(1)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=simulated_run)] + [
+        threading.Thread(target=reader) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert reads
+    assert len(db.get_runs_page(pool.get())[0]) == 20
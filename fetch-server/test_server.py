@@ -0,0 +1,172 @@
+"""Tests for server.py routes, called directly rather than over HTTP."""
+import asyncio
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import config as cfg
+import db
+import pipeline
+import server
+from pool import ConnectionPool
+
+
+@pytest.fixture(autouse=True)
+def pool(db_path, tmp_path, monkeypatch):
+    """Point the server at the test DB (the one `conn` opens) and a default config."""
+    config = {**cfg.DEFAULTS, 'db_path': db_path,
+              'dropbox_cache_file': str(tmp_path / 'cache.json')}
+    pool = ConnectionPool(db_path)
+    monkeypatch.setattr(server, '_config', config)
+    monkeypatch.setattr(server, '_clients', pipeline.Clients(config))
+    monkeypatch.setattr(server, '_pool', pool)
+    monkeypatch.setattr(server, '_live', server.LiveLog())
+    yield pool
+    pool.close_all()
+
+
+def _events(run_id: int) -> list:
+    async def main():
+        response = await server.run_events(run_id)
+        return [chunk async for chunk in response.body_iterator]
+    return [json.loads(chunk.split('data: ', 1)[1]) for chunk in asyncio.run(main())]
+
+
+# ── lifespan ──────────────────────────────────────────────────────────────────
+
+def test_lifespan_migrates_the_configured_db(tmp_path, monkeypatch):
+    path = str(tmp_path / 'new.db')
+    monkeypatch.setitem(server._config, 'db_path', path)
+    monkeypatch.setattr(server, '_pool', ConnectionPool(path))
+    monkeypatch.setattr(server, '_scheduler', server.BackgroundScheduler())
+    monkeypatch.setattr(server, '_db_executor', server.ThreadPoolExecutor(max_workers=1))
+
+    async def main():
+        async with server.lifespan(server.app):
+            assert server._scheduler.get_job('fetch')
+
+    asyncio.run(main())
+    c = db.get_conn(path)
+    assert c.execute('PRAGMA user_version').fetchone()[0] == len(db.MIGRATIONS)
+    c.close()
+
+
+# ── /run/{run_id}/events ──────────────────────────────────────────────────────
+
+def test_events_for_finished_run_end_with_its_status(conn):
+    run_id = db.start_run(conn)
+    db.finish_run(conn, run_id, 'success')
+    assert _events(run_id) == [{'type': 'end', 'status': 'success'}]
+
+
+def test_events_for_run_orphaned_by_restart(conn):
+    run_id = db.start_run(conn)  # never finished: the server stopped mid-run
+    assert _events(run_id) == [{'type': 'end', 'status': 'running'}]
+
+    assert db.fail_interrupted_runs(conn) == 1
+    assert _events(run_id) == [{'type': 'end', 'status': 'error'}]
+    assert db.get_run_log(conn, run_id)[0]['level'] == 'error'
+    assert db.fail_interrupted_runs(conn) == 0
+
+
+# ── /runs.json ────────────────────────────────────────────────────────────────
+
+def _runs(**params) -> dict:
+    return json.loads(asyncio.run(server.runs_json(**params)).body)
+
+
+def _ids(page: dict) -> list:
+    return [run['id'] for run in page['runs']]
+
+
+def test_runs_json_pages_back_and_forward(conn):
+    ids = [db.start_run(conn) for _ in range(5)]
+    for run_id in ids:
+        db.finish_run(conn, run_id, 'success')
+
+    first = _runs(limit=2)
+    assert (_ids(first), first['older'], first['newer']) == ([ids[4], ids[3]], ids[3], None)
+    assert first['runs'][0]['duration_seconds'] == 0
+
+    second = _runs(before=first['older'], limit=2)
+    assert (_ids(second), second['older'], second['newer']) == ([ids[2], ids[1]], ids[1], ids[2])
+
+    last = _runs(before=second['older'], limit=2)
+    assert (_ids(last), last['older'], last['newer']) == ([ids[0]], None, ids[0])
+
+    back = _runs(after=last['newer'], limit=2)
+    assert _ids(back) == _ids(second)
+    assert (back['older'], back['newer']) == (ids[1], ids[2])
+    assert _runs(after=back['newer'], limit=2)['newer'] is None
+
+
+def test_runs_json_clamps_limit(conn):
+    db.start_run(conn)
+    assert _runs(limit=0)['limit'] == 1
+    assert _runs(limit=10_000)['limit'] == server.MAX_RUNS_PAGE_SIZE
+    assert _runs()['limit'] == server._config['runs_page_size']
+
+
+@pytest.mark.parametrize('cursor', ['before', 'after'])
+def test_runs_json_unknown_cursor_is_404(conn, cursor):
+    db.start_run(conn)
+    with pytest.raises(server.HTTPException) as e:
+        _runs(**{cursor: 999})
+    assert e.value.status_code == 404
+
+
+# ── /metrics ──────────────────────────────────────────────────────────────────
+
+def test_metrics_route_serves_lock_wait_and_scheduler_lag():
+    with server._run_lock_held('summary'):
+        pass
+    planned = datetime.now(timezone.utc) - timedelta(seconds=2)
+    server._on_job_submitted(SimpleNamespace(job_id='fetch', scheduled_run_times=[planned]))
+
+    response = asyncio.run(server.prometheus_metrics())
+    text = response.body.decode()
+
+    assert response.media_type.startswith('text/plain; version=0.0.4')
+    assert '# TYPE fetch_run_lock_wait_seconds histogram' in text
+    lag = {line.split(' ')[0]: float(line.split(' ')[1]) for line in text.splitlines()
+           if line.startswith('fetch_scheduler_lag_seconds')}
+    assert lag['fetch_scheduler_lag_seconds_count{job="fetch"}'] >= 1
+    assert lag['fetch_scheduler_lag_seconds_bucket{job="fetch",le="1"}'] < \
+        lag['fetch_scheduler_lag_seconds_bucket{job="fetch",le="5"}']
+    assert 'fetch_run_lock_wait_seconds_count{job="summary"}' in text
+
+
+# ── Blocking work off the event loop ──────────────────────────────────────────
+
+def test_runs_json_responds_during_a_long_run(conn, monkeypatch):
+    db.finish_run(conn, db.start_run(conn), 'success')
+    started, release = threading.Event(), threading.Event()
+
+    def long_run(conn, config, log, **kwargs):
+        # Hold a write transaction open, like a run's parse stage does.
+        with db.transaction(conn):
+            db.start_run(conn)
+            started.set()
+            release.wait(10)
+
+    monkeypatch.setattr(server.pipeline, 'run', long_run)
+    fetch = threading.Thread(target=server._do_run)
+    fetch.start()
+    try:
+        assert started.wait(5)
+
+        async def main():
+            return await asyncio.wait_for(
+                asyncio.gather(server.runs_json(), server.ping()), timeout=2)
+
+        page, pong = asyncio.run(main())
+        assert server._is_running()
+        assert len(json.loads(page.body)['runs']) == 1  # the open run isn't committed yet
+        assert pong == 'pong'
+    finally:
+        release.set()
+        fetch.join()
+    assert len(_runs()['runs']) == 2
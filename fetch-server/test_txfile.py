@@ -0,0 +1,32 @@
+"""Unit tests for transactions.json reading and writing in txfile.py."""
+import json
+
+import pytest
+
+import txfile
+
+TRANSACTIONS = [
+    {'id': 'a', 'date': '2026-04-27', 'description': 'CAFÉ “LUNA”', 'amount_cents': -1250,
+     'tags': ['food'], 'transactions': [], 'source': 'email_chase', 'notes': 'tab\there'},
+    {'id': 'b', 'date': '2026-04-26', 'description': 'SPLIT', 'amount_cents': 3000.5,
+     'tags': [], 'source': 'manual', 'notes': None,
+     'transactions': [{'id': 'b1', 'date': '2026-04-26', 'amount_cents': 1500, 'transactions': []}]},
+]
+
+
+@pytest.mark.parametrize('batch', [1, 2, txfile.DUMP_BATCH])
+@pytest.mark.parametrize('transactions', [[], TRANSACTIONS[:1], TRANSACTIONS * 2])
+def test_dump_matches_json_dumps(monkeypatch, transactions, batch):
+    monkeypatch.setattr(txfile, 'DUMP_BATCH', batch)
+    assert txfile.dump(transactions) == json.dumps(transactions).encode('utf-8')
+
+
+@pytest.mark.parametrize('backend', ['orjson', 'json'])
+def test_load_round_trips(monkeypatch, backend):
+    if backend == 'json':
+        monkeypatch.setattr(txfile, 'orjson', None)
+    elif txfile.orjson is None:
+        pytest.skip('orjson not installed')
+    data = json.dumps(TRANSACTIONS, ensure_ascii=False).encode('utf-8')
+    assert txfile.load(data) == TRANSACTIONS
+    assert txfile.load(txfile.dump(TRANSACTIONS)) == TRANSACTIONS
@@ -0,0 +1,53 @@
+"""
+Reading and writing transactions.json without extra whole-file copies.
+
+load() parses straight from the downloaded bytes, with orjson when it is
+installed, instead of decoding them to a str first. dump() produces exactly
+the bytes json.dumps(transactions).encode() always has, but encodes
+DUMP_BATCH transactions at a time into a single buffer, so no whole-file str
+exists next to the result.
+
+The delta journal (see pipeline.append_to_delta) is JSON Lines: one
+json.dumps'd transaction per line, so appending never rewrites earlier lines.
+"""
+import io
+import json
+
+try:
+    import orjson
+except ImportError:  # optional; json.loads is used instead
+    orjson = None
+
+
+def load(data: bytes) -> list:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# Transactions serialized per json.dumps call: large enough to amortize its
+# per-call setup, small enough that each chunk is a few hundred KB.
+DUMP_BATCH = 1000
+
+
+def dump(transactions: list) -> bytes:
+    buf = io.BytesIO()
+    buf.write(b'[')
+    for start in range(0, len(transactions), DUMP_BATCH):
+        if start:
+            buf.write(b', ')
+        # Strip the batch's own brackets. ensure_ascii (the default) makes
+        # every chunk plain ASCII.
+        buf.write(json.dumps(transactions[start:start + DUMP_BATCH])[1:-1].encode('ascii'))
+    buf.write(b']')
+    # getvalue() hands over the buffer without copying it.
+    return buf.getvalue()
+
+
+def load_lines(data: bytes) -> list:
+    loads = orjson.loads if orjson is not None else json.loads
+    return [loads(line) for line in data.splitlines() if line.strip()]
+
+
+def dump_lines(transactions: list) -> bytes:
+    return b''.join(json.dumps(t).encode('ascii') + b'\n' for t in transactions)